@@ -21,9 +21,3 @@ if __name__ != '__main__':
 		app.logger.setLevel(gunicorn_logger.level)
 
 app.logger.info('Logging established')
-
-
-@app.before_first_request
-def init_db(dbname="wishlists"):
-	""" Initlaize the model """
-	Wishlist.init_db(dbname)
\ No newline at end of file
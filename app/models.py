@@ -8,22 +8,140 @@ Models
 Wishlist - A wishlist owned by a user
 Wishlist Entry - A product entry to a wishlist
 
+Storage Engines
+---------------
+StorageEngine - The interface of the document stores a Wishlist is kept in
+CloudantEngine - Keeps Wishlists in a Cloudant or CouchDB database
+MemoryEngine - Keeps Wishlists in process memory
+SQLiteEngine - Keeps Wishlists in an embedded SQLite database
+MeasuredEngine - Times the calls the Wishlist model makes to its engine
+
 """
 
 import threading
 import json
 import os
 import logging
+import time
+import uuid
+import copy
+import random
+import functools
+import socket
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+import jsonpatch
 from cloudant.client import Cloudant
+from cloudant.document import Document
 from cloudant.query import Query
 from requests import HTTPError, ConnectionError
-from retry import retry
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.utils import quote
+from sqlalchemy import create_engine, event, MetaData, Table, Column, Index, ForeignKey, \
+	Integer, String, select, bindparam, func, and_, true
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 
 # get configruation from enviuronment (12-factor)
 ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
 CLOUDANT_HOST = os.environ.get('CLOUDANT_HOST', 'localhost')
 CLOUDANT_USERNAME = os.environ.get('CLOUDANT_USERNAME', 'admin')
 CLOUDANT_PASSWORD = os.environ.get('CLOUDANT_PASSWORD', 'pass')
+# Connections kept open to Cloudant per process, shared by the threads of a
+# worker, and seconds of idleness before TCP keep-alive probes start
+CLOUDANT_POOL_SIZE = int(os.environ.get('CLOUDANT_POOL_SIZE', '16'))
+CLOUDANT_KEEPALIVE = int(os.environ.get('CLOUDANT_KEEPALIVE', '60'))
+
+# Storage engine Wishlist.init_db opens, one of STORAGE_ENGINES
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'cloudant').lower()
+
+# Directory the SQLite storage engine keeps its database files in
+SQLITE_DIR = os.environ.get('SQLITE_DIR', '.')
+
+# Size and time to live (seconds) of the Wishlist.find read-through cache
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', '1000'))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '30'))
+
+# Number of documents written per _bulk_docs request
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '100'))
+
+# Retries of storage I/O, see RetryPolicy: attempts per call, the first and
+# the largest backoff (seconds), retries per request and request deadline
+RETRY_TRIES = int(os.environ.get('RETRY_TRIES', '4'))
+RETRY_DELAY = float(os.environ.get('RETRY_DELAY', '0.1'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '2'))
+RETRY_BUDGET = int(os.environ.get('RETRY_BUDGET', '4'))
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '10'))
+# HTTP statuses that are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Circuit breaker of storage I/O, see CircuitBreaker: calls remembered, calls
+# needed to open, failing share that opens it, seconds a call may take and
+# seconds it stays open before a probe
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '10'))
+BREAKER_FAILURE_RATIO = float(os.environ.get('BREAKER_FAILURE_RATIO', '0.5'))
+BREAKER_SLOW_CALL = float(os.environ.get('BREAKER_SLOW_CALL', '2'))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', '5'))
+
+# Adaptive limit of storage requests in flight, see ConcurrencyLimiter: the
+# first, smallest and largest limit, the factor a 429 shrinks it by, and
+# how many requests may wait for a slot and for how many seconds
+LIMITER_INITIAL = int(os.environ.get('LIMITER_INITIAL', '8'))
+LIMITER_MIN = int(os.environ.get('LIMITER_MIN', '1'))
+LIMITER_MAX = int(os.environ.get('LIMITER_MAX', '64'))
+LIMITER_DECREASE = float(os.environ.get('LIMITER_DECREASE', '0.5'))
+LIMITER_MAX_QUEUE = int(os.environ.get('LIMITER_MAX_QUEUE', '64'))
+LIMITER_QUEUE_TIMEOUT = float(os.environ.get('LIMITER_QUEUE_TIMEOUT', '5'))
+
+# Upper bounds (seconds) of the latency histogram buckets /metrics reports
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Storage engine methods the Wishlist model calls, timed by MeasuredEngine
+STORAGE_OPERATIONS = frozenset([
+	'warm_up', 'create', 'get', 'revision', 'update', 'delete', 'query', 'bulk_create',
+	'bulk_delete', 'iterate', 'remove', 'add_entry', 'delete_entry'])
+
+# Fields of a stored document that project_document reads
+PROJECTED_FIELDS = ['_id', 'name', 'user', 'entries']
+
+# Attempts of a read-modify-write before giving up on conflicts
+ENTRY_WRITE_TRIES = 5
+
+# Cloudant update handlers that change a single entry of a wishlist in place
+ENTRY_HANDLERS_DDOC = '_design/entries'
+ENTRY_HANDLERS = {
+	'add_entry': """function (doc, req) {
+		if (!doc) { return [null, {code: 404, json: {error: 'not_found'}}]; }
+		var entry = {id: 0, name: JSON.parse(req.body).name};
+		doc.entries = doc.entries || [];
+		for (var i = 0; i < doc.entries.length; i++) {
+			if (doc.entries[i].id >= entry.id) { entry.id = doc.entries[i].id + 1; }
+		}
+		doc.entries.push(entry);
+		return [doc, {code: 201, json: entry}];
+	}""",
+	'delete_entry': """function (doc, req) {
+		if (!doc) { return [null, {code: 404, json: {error: 'not_found'}}]; }
+		var id = parseInt(req.query.entry_id, 10);
+		var kept = (doc.entries || []).filter(function (e) { return e.id !== id; });
+		if (kept.length === (doc.entries || []).length) {
+			return [null, {code: 404, json: {error: 'entry_not_found'}}];
+		}
+		doc.entries = kept;
+		return [doc, {code: 200, json: {id: id}}];
+	}"""
+}
+
+# Mango indexes the finders rely on: (design document, indexed fields)
+# Each index lives in its own design document named after the fields.
+INDEX_PREFIX = 'wishlist-'
+QUERY_INDEXES = [
+	('wishlist-user', ['user']),
+	('wishlist-name', ['name']),
+	('wishlist-user-name', ['user', 'name']),
+]
 
 class DataValidationError(Exception):
 	""" Used for an data validation errors when deserializing """
@@ -34,11 +152,612 @@ class DatabaseConnectionError(ConnectionError):
     pass
 
 
+class CircuitOpenError(DatabaseConnectionError):
+	""" Used when storage I/O is refused because the circuit breaker is open """
+	def __init__(self, message, retry_after=None):
+		super(CircuitOpenError, self).__init__(message)
+		self.retry_after = retry_after
+
+
+class StorageOverloadError(DatabaseConnectionError):
+	""" Used when a storage request is shed because too many are waiting """
+	def __init__(self, message, retry_after=None):
+		super(StorageOverloadError, self).__init__(message)
+		self.retry_after = retry_after
+
+
+class DataConflictError(Exception):
+	""" Used when a write is based on a revision that is no longer current """
+	pass
+
+
+class LRUCache(object):
+	"""
+	Bounded least recently used cache whose entries expire after a TTL
+
+	"""
+	def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, timer=time.time):
+		""" Initialize an empty cache, a maxsize of 0 disables caching """
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.timer = timer
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def get(self, key):
+		""" Returns the live value cached under key or None """
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			value, expires = entry
+			if expires <= self.timer():
+				self.expirations += 1
+				self.misses += 1
+				return None
+			# re-insert to mark it as the most recently used
+			self.entries[key] = entry
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		""" Caches value under key, evicting the least recently used entry """
+		if self.maxsize <= 0:
+			return
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (value, self.timer() + self.ttl)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		""" Drops the entry cached under key """
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		""" Drops every entry """
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		""" Returns the size and hit, miss and eviction counters """
+		with self.lock:
+			return {
+				'size': len(self.entries),
+				'maxsize': self.maxsize,
+				'ttl': self.ttl,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'expirations': self.expirations
+			}
+
+
+class SharedLocal(object):
+	""" Stands in for threading.local where every greenlet shares one value """
+	pass
+
+
+def is_cooperative():
+	""" Checks if gevent has turned threads into cooperative greenlets """
+	try:
+		from gevent import monkey
+	except ImportError:
+		return False
+	return monkey.is_module_patched('threading')
+
+
+class Metrics(object):
+	"""
+	Counters, gauges and latency histograms in the Prometheus text format
+
+	Every thread records into values of its own, so recording takes no
+	lock. A scrape adds up the values of all threads, keeping those of
+	threads that have finished. Greenlets never run at the same time, so
+	under gevent they all record into one set of values.
+	"""
+	def __init__(self, buckets=LATENCY_BUCKETS, timer=time.time):
+		""" Initialize the metrics, buckets are the upper bounds of histograms """
+		self.buckets = tuple(buckets)
+		self.timer = timer
+		self.cooperative = is_cooperative()
+		self.local = SharedLocal() if self.cooperative else threading.local()
+		self.lock = threading.Lock()
+		self.families = OrderedDict()
+		# (thread, values) of every thread recording, None under gevent
+		self.threads = []
+		self.retired = {}
+
+	def family(self, name, kind, description, labels=()):
+		""" Declares a counter, gauge or histogram and the names of its labels """
+		self.families[name] = (kind, description, tuple(labels))
+
+	def inc(self, name, labels=(), amount=1):
+		""" Adds to a counter or a gauge """
+		values = self.values()
+		key = (name, labels)
+		values[key] = values.get(key, 0) + amount
+
+	def dec(self, name, labels=()):
+		""" Takes one from a gauge """
+		self.inc(name, labels, -1)
+
+	def observe(self, name, labels, seconds):
+		""" Counts a latency in its histogram bucket """
+		values = self.values()
+		key = (name, labels)
+		histogram = values.get(key)
+		if histogram is None:
+			# a count per bucket and one above the last, then the sum
+			histogram = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+		histogram[bisect_left(self.buckets, seconds)] += 1
+		histogram[-1] += seconds
+
+	def values(self):
+		""" Returns the values the calling thread records into """
+		try:
+			return self.local.values
+		except AttributeError:
+			values = self.local.values = {}
+			owner = None if self.cooperative else threading.current_thread()
+			with self.lock:
+				self.retire()
+				self.threads.append((owner, values))
+			return values
+
+	def retire(self):
+		""" Folds the values of finished threads into the retired ones, holding the lock """
+		running = []
+		for owner, values in self.threads:
+			if owner is None or owner.is_alive():
+				running.append((owner, values))
+			else:
+				add_values(self.retired, values)
+		self.threads = running
+
+	def snapshot(self):
+		""" Returns the values of every thread added up """
+		with self.lock:
+			self.retire()
+			totals = {}
+			add_values(totals, self.retired)
+			for _, values in self.threads:
+				add_values(totals, values)
+		return totals
+
+	def render(self):
+		""" Returns every family in the Prometheus text exposition format """
+		samples = {}
+		for (name, labels), value in self.snapshot().items():
+			samples.setdefault(name, []).append((labels, value))
+		bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+		lines = []
+		for name, (kind, description, label_names) in self.families.items():
+			lines.append('# HELP {} {}'.format(name, description))
+			lines.append('# TYPE {} {}'.format(name, kind))
+			for labels, value in sorted(samples.get(name, [])):
+				pairs = zip(label_names, labels)
+				if kind != 'histogram':
+					lines.append(sample_line(name, pairs, value))
+					continue
+				count = 0
+				for bound, bucket in zip(bounds, value):
+					count += bucket
+					lines.append(sample_line(name + '_bucket', pairs + [('le', bound)], count))
+				lines.append(sample_line(name + '_sum', pairs, value[-1]))
+				lines.append(sample_line(name + '_count', pairs, count))
+		return '\n'.join(lines) + '\n'
+
+
+# request and storage metrics reported by /metrics
+service_metrics = Metrics()
+service_metrics.family('wishlist_storage_request_duration_seconds', 'histogram',
+	'Seconds the storage engine took to answer a call of the Wishlist model',
+	('engine', 'operation', 'outcome'))
+service_metrics.family('wishlist_storage_requests_in_flight', 'gauge',
+	'Calls of the Wishlist model the storage engine is answering', ('engine',))
+service_metrics.family('wishlist_storage_retries_total', 'counter',
+	'Storage calls retried after a transient error', ('operation',))
+service_metrics.family('wishlist_storage_retries_exhausted_total', 'counter',
+	'Storage calls that failed with no retries left', ('operation',))
+
+
+class RoundTrips(object):
+	"""
+	Counts and times the storage calls made while serving one request
+
+	start_request gives the calling thread empty ledgers. MeasuredEngine
+	records every call of the Wishlist model in them, and PooledCloudant
+	every HTTP request its sessions send, so the HEAD requests, logins
+	and retries behind one call show up in the totals too. Calls made
+	outside a request are not recorded.
+	"""
+	def __init__(self):
+		""" Initialize the ledgers, one per thread """
+		self.local = threading.local()
+
+	def start_request(self):
+		""" Gives the calling thread empty ledgers """
+		self.local.calls = OrderedDict()
+		self.local.http = OrderedDict()
+
+	def end_request(self):
+		""" Drops the ledgers of the calling thread """
+		self.local.__dict__.clear()
+
+	def record(self, operation, seconds):
+		""" Adds a call of the Wishlist model to the ledger of the calling thread """
+		self.add(getattr(self.local, 'calls', None), operation, seconds)
+
+	def record_http(self, method, seconds):
+		""" Adds an HTTP request to the storage to the ledger of the calling thread """
+		self.add(getattr(self.local, 'http', None), method.lower(), seconds)
+
+	@staticmethod
+	def add(ledger, key, seconds):
+		""" Adds a call to a ledger, if there is one """
+		if ledger is None:
+			return
+		totals = ledger.get(key)
+		if totals is None:
+			ledger[key] = [1, seconds]
+		else:
+			totals[0] += 1
+			totals[1] += seconds
+
+	def calls(self):
+		""" Returns the [count, seconds] of every operation called in this request """
+		return getattr(self.local, 'calls', None) or {}
+
+	def http_calls(self):
+		""" Returns the [count, seconds] of every HTTP method sent in this request """
+		return getattr(self.local, 'http', None) or {}
+
+
+# storage calls of the request being served, reported in Server-Timing
+storage_round_trips = RoundTrips()
+
+
+class RetryPolicy(object):
+	"""
+	Retries transient storage I/O errors with exponential backoff and jitter
+
+	Connection errors and HTTP 429 and 5xx responses are retried, anything
+	else is raised at once. A request started with start_request shares
+	one budget of retries and one deadline across all of its I/O, so a
+	slow database cannot hold a worker in backoff for long.
+	"""
+	def __init__(self, tries=RETRY_TRIES, delay=RETRY_DELAY, max_delay=RETRY_MAX_DELAY,
+				 budget=RETRY_BUDGET, deadline=REQUEST_DEADLINE,
+				 timer=time.time, sleep=time.sleep, jitter=random.random, metrics=None):
+		""" Initialize the policy, tries counts the first attempt too """
+		self.tries = tries
+		self.delay = delay
+		self.max_delay = max_delay
+		self.budget = budget
+		self.deadline = deadline
+		self.timer = timer
+		self.sleep = sleep
+		self.jitter = jitter
+		self.metrics = metrics
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.retries = 0
+		self.exhausted = 0
+
+	def __call__(self, function):
+		""" Decorates a function that does storage I/O """
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			return self.call(function, *args, **kwargs)
+		return wrapper
+
+	def start_request(self, deadline=None):
+		""" Gives the calling thread a fresh retry budget and deadline """
+		self.local.budget = self.budget
+		self.local.deadline = self.timer() + (deadline or self.deadline)
+
+	def end_request(self):
+		""" Drops the budget of the calling thread """
+		self.local.__dict__.clear()
+
+	def call(self, function, *args, **kwargs):
+		""" Calls function, retrying it while the error is transient """
+		attempt = 1
+		while True:
+			try:
+				return function(*args, **kwargs)
+			except (HTTPError, ConnectionError) as err:
+				if not is_transient(err):
+					raise
+				delay = self.backoff(attempt, err)
+				if not self.spend(attempt, delay):
+					with self.lock:
+						self.exhausted += 1
+					if self.metrics:
+						self.metrics.inc('wishlist_storage_retries_exhausted_total', (function.__name__,))
+					if isinstance(err, HTTPError):
+						raise
+					raise DatabaseConnectionError(str(err))
+				logging.getLogger(__name__).warning(
+					'Retrying %s in %.2fs after attempt %d: %s',
+					function.__name__, delay, attempt, err)
+				if self.metrics:
+					self.metrics.inc('wishlist_storage_retries_total', (function.__name__,))
+				self.sleep(delay)
+				attempt += 1
+
+	def backoff(self, attempt, error):
+		""" Returns a full jitter delay, at least the Retry-After of the response """
+		delay = self.jitter() * min(self.max_delay, self.delay * 2 ** (attempt - 1))
+		return max(delay, retry_after(error))
+
+	def spend(self, attempt, delay):
+		""" Takes one retry from the budget, False when none is left """
+		if attempt >= self.tries:
+			return False
+		budget = getattr(self.local, 'budget', None)
+		if budget is not None:
+			if budget <= 0 or self.timer() + delay > self.local.deadline:
+				return False
+			self.local.budget = budget - 1
+		with self.lock:
+			self.retries += 1
+		return True
+
+	def stats(self):
+		""" Returns the number of retries and of errors raised once out of retries """
+		with self.lock:
+			return {'retries': self.retries, 'exhausted': self.exhausted}
+
+
+# retries the storage I/O of the engines that talk to a server
+storage_retry = RetryPolicy(metrics=service_metrics)
+
+
+class CircuitBreaker(object):
+	"""
+	Fails storage I/O fast while the database is failing or too slow
+
+	The breaker opens when enough of the last window calls failed with a
+	transient error or took longer than slow_call seconds. While open it
+	raises a CircuitOpenError without calling the database. After
+	reset_timeout seconds it lets a single probe through (half open),
+	which closes the breaker again if it succeeds.
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+				 failure_ratio=BREAKER_FAILURE_RATIO, slow_call=BREAKER_SLOW_CALL,
+				 reset_timeout=BREAKER_RESET_TIMEOUT, timer=time.time):
+		""" Initialize a closed breaker """
+		self.min_calls = min_calls
+		self.failure_ratio = failure_ratio
+		self.slow_call = slow_call
+		self.reset_timeout = reset_timeout
+		self.timer = timer
+		self.lock = threading.Lock()
+		self.outcomes = deque(maxlen=window)
+		self.state = self.CLOSED
+		self.opened_at = 0
+		self.probing = False
+		self.opened = 0
+		self.rejected = 0
+
+	def __call__(self, function):
+		""" Decorates a function that does storage I/O """
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			return self.call(function, *args, **kwargs)
+		return wrapper
+
+	def call(self, function, *args, **kwargs):
+		""" Calls function unless the breaker is open, recording the outcome """
+		probe = self.admit()
+		start = self.timer()
+		try:
+			result = function(*args, **kwargs)
+		except (HTTPError, ConnectionError) as err:
+			self.record(probe, not is_transient(err) and self.timer() - start < self.slow_call)
+			raise
+		except Exception:
+			self.record(probe, True)
+			raise
+		self.record(probe, self.timer() - start < self.slow_call)
+		return result
+
+	def admit(self):
+		""" Returns True when the call is the half open probe, raises when open """
+		with self.lock:
+			if self.state == self.CLOSED:
+				return False
+			wait = self.opened_at + self.reset_timeout - self.timer()
+			if wait <= 0 and not self.probing:
+				self.state = self.HALF_OPEN
+				self.probing = True
+				return True
+			self.rejected += 1
+		raise CircuitOpenError('The database is unavailable, retry in {:.0f}s'.format(max(wait, 1)),
+							   retry_after=max(wait, 1))
+
+	def record(self, probe, healthy):
+		""" Records the outcome of a call and opens or closes the breaker """
+		with self.lock:
+			if probe:
+				self.probing = False
+				if healthy:
+					self.state = self.CLOSED
+					self.outcomes.clear()
+				else:
+					self.trip()
+				return
+			if self.state != self.CLOSED:
+				return
+			self.outcomes.append(healthy)
+			failures = self.outcomes.count(False)
+			if len(self.outcomes) >= self.min_calls and \
+					failures >= self.failure_ratio * len(self.outcomes):
+				self.trip()
+
+	def trip(self):
+		""" Opens the breaker, the lock must be held """
+		logging.getLogger(__name__).warning('Opening the database circuit breaker')
+		self.state = self.OPEN
+		self.opened_at = self.timer()
+		self.opened += 1
+		self.outcomes.clear()
+
+	def reset(self):
+		""" Closes the breaker and forgets every outcome """
+		with self.lock:
+			self.state = self.CLOSED
+			self.probing = False
+			self.outcomes.clear()
+
+	def stats(self):
+		""" Returns the state and how often the breaker opened and rejected calls """
+		with self.lock:
+			return {'state': self.state, 'opened': self.opened, 'rejected': self.rejected}
+
+
+# guards the storage I/O of the engines that talk to a server
+storage_breaker = CircuitBreaker()
+
+
+class ConcurrencyLimiter(object):
+	"""
+	Caps the storage requests in flight with an AIMD adaptive limit
+
+	Every successful request raises the limit by 1/limit, about one per
+	round of requests, and a 429 response halves it once per round. A
+	Retry-After pauses every request until it has passed. Requests over
+	the limit queue for up to queue_timeout seconds, and once max_queue
+	are waiting further requests are shed with a StorageOverloadError.
+	Nested requests of a thread that already holds a slot pass through.
+	"""
+	def __init__(self, initial=LIMITER_INITIAL, minimum=LIMITER_MIN, maximum=LIMITER_MAX,
+				 decrease=LIMITER_DECREASE, max_queue=LIMITER_MAX_QUEUE,
+				 queue_timeout=LIMITER_QUEUE_TIMEOUT, timer=time.time):
+		""" Initialize the limiter with nothing in flight """
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.decrease = decrease
+		self.max_queue = max_queue
+		self.queue_timeout = queue_timeout
+		self.timer = timer
+		self.condition = threading.Condition()
+		self.local = threading.local()
+		self.in_flight = 0
+		self.waiting = 0
+		self.paused_until = 0
+		self.epoch = 0
+		self.throttled = 0
+		self.shed = 0
+
+	def __call__(self, function):
+		""" Decorates a function that makes a storage request """
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			return self.call(function, *args, **kwargs)
+		return wrapper
+
+	def call(self, function, *args, **kwargs):
+		""" Calls function once a slot is free, adapting the limit to the outcome """
+		if getattr(self.local, 'held', False):
+			return function(*args, **kwargs)
+		epoch = self.acquire()
+		self.local.held = True
+		try:
+			result = function(*args, **kwargs)
+		except HTTPError as err:
+			throttled = err.response is not None and err.response.status_code == 429
+			self.release(epoch, throttled=throttled, retry_after=retry_after(err))
+			raise
+		except Exception:
+			self.release(epoch)
+			raise
+		finally:
+			self.local.held = False
+		self.release(epoch, succeeded=True)
+		return result
+
+	def acquire(self):
+		""" Waits for a slot and returns the epoch of the limit it was taken under """
+		with self.condition:
+			if not self.available() and self.waiting >= self.max_queue:
+				self.refuse('Too many database requests are queued')
+			deadline = self.timer() + self.queue_timeout
+			self.waiting += 1
+			try:
+				while not self.available():
+					remaining = deadline - self.timer()
+					if remaining <= 0:
+						self.refuse('Timed out waiting for a database request slot')
+					pause = self.paused_until - self.timer()
+					self.condition.wait(min(remaining, pause) if pause > 0 else remaining)
+			finally:
+				self.waiting -= 1
+			self.in_flight += 1
+			return self.epoch
+
+	def release(self, epoch, succeeded=False, throttled=False, retry_after=0):
+		""" Frees a slot, growing the limit on success and shrinking it on a 429 """
+		with self.condition:
+			self.in_flight -= 1
+			if succeeded:
+				self.limit = min(self.maximum, self.limit + 1 / self.limit)
+			elif throttled:
+				self.throttled += 1
+				# a burst of 429s from requests sent under one limit shrinks it once
+				if epoch == self.epoch:
+					self.epoch += 1
+					self.limit = max(self.minimum, self.limit * self.decrease)
+				if retry_after:
+					self.paused_until = max(self.paused_until, self.timer() + retry_after)
+			self.condition.notify_all()
+
+	def available(self):
+		""" Checks if a request may start now, the condition must be held """
+		return self.in_flight < int(self.limit) and self.paused_until <= self.timer()
+
+	def refuse(self, message):
+		""" Sheds a request, the condition must be held """
+		self.shed += 1
+		raise StorageOverloadError(message, retry_after=max(self.paused_until - self.timer(), 1))
+
+	def stats(self):
+		""" Returns the limit, the requests in flight and waiting, and the counters """
+		with self.condition:
+			return {
+				'limit': int(self.limit),
+				'in_flight': self.in_flight,
+				'waiting': self.waiting,
+				'throttled': self.throttled,
+				'shed': self.shed
+			}
+
+
+# paces the storage requests of the engines that talk to a server
+storage_limiter = ConcurrencyLimiter()
+
+
 class Wishlist_entry(object):
 	"""
 	Class that represents a Wishlist Entry
 
 	"""
+	# slots instead of a __dict__ keep the N entries of a listing compact
+	__slots__ = ('id', 'name')
 	lock = threading.Lock()
 	index = 0
 
@@ -51,71 +770,101 @@ class Wishlist_entry(object):
 		""" Serializes a Wishlist_entry into a dictionary """
 		return {"id": self.id, "name": self.name}
 
+	def deserialize(self, data):
+		"""
+		Deserializes a Wishlist_entry from a dictionary
+		Args:
+		data (dict): A dictionary containing the entry data
+		"""
+		try:
+			self.name = data['name']
+		except KeyError as err:
+			raise DataValidationError('Invalid entry: missing ' + err.args[0])
+		except TypeError as err:
+			raise DataValidationError('Invalid entry: body of request contained bad or no data')
+		return self
+
 
 class Wishlist(object):
 	logger = logging.getLogger(__name__)
+	# the storage engine opened by init_db
+	engine = None
+	# the Cloudant client and database when the Cloudant engine is used
 	client = None
 	database = None
+	# documents read by find, keyed by id, each holding the _rev it was read
+	# at and only served after checking it against the stored revision
+	cache = LRUCache()
 
 	"""
 	Class that represents a Wishlist
 
 	"""
+	__slots__ = ('id', 'rev', 'name', 'user', 'entries')
 	lock = threading.Lock()
 	data = []
 	index = 0
 
-	def __init__(self, wishlist_name=None, wishlist_user=None, wishlist_entries=[]):
+	def __init__(self, wishlist_name=None, wishlist_user=None, wishlist_entries=None):
 		""" Initialize a wishlist """
 		self.id = None
+		self.rev = None
 		self.name = wishlist_name
 		self.user = wishlist_user
-		self.entries = wishlist_entries
+		self.entries = [] if wishlist_entries is None else wishlist_entries
 
 	def equals(self, other): # pragma: no cover
-		return self.__dict__ == other.__dict__
+		return self.serialize() == other.serialize() and self.rev == other.rev
 
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
 	def create(self):
 		"""
 		Creates a new Wishlist in the database
+		Returns True if the Wishlist was written
 		"""
 		if self.name is None or self.user is None:   # name is the only required field
 			raise DataValidationError('name attribute is not set')
 
 		try:
-			document = self.database.create_document(self.serialize())
+			created = Wishlist.engine.create(self.serialize())
 		except HTTPError as err:
 			Wishlist.logger.warning('Create failed: %s', err)
-			return
+			return False
 
-		if document.exists():
-			self.id = document['_id']
+		if not created:
+			return False
+		self.id, self.rev = created
+		Wishlist.cache.invalidate(self.id)
+		return True
 
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
 	def update(self):
 		"""
 		Updates a Wishlist in the database
+
+		The revision the Wishlist was read at is written back, so the
+		update is a single request that fails with a DataConflictError
+		if the document was changed since. Returns False if the Wishlist
+		no longer exists.
 		"""
-		try:
-			document = self.database[self.id]
-		except KeyError:
-			document = None
-		if document:
-			document.update(self.serialize())
-			document.save()
+		rev = self.rev or Wishlist.revision(self.id)
+		if not rev:
+			Wishlist.logger.warning('Update failed: %s not found', self.id)
+			return False
+		new_rev = Wishlist._put_document(self.id, rev, self.serialize())
+		if not new_rev:
+			return False
+		self.rev = new_rev
+		return True
 
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
 	def save(self):
 		"""
 		Saves a Wishlist to the data store
+		Returns True if the Wishlist was written
 		"""
 		if self.name is None or self.user is None:   # name is the only required field
 			raise DataValidationError('name attribute is not set')
 		if self.id:
-			self.update()
-		else:
-			self.create()
+			return self.update()
+		return self.create()
 		# if self.id == 0:
 		#     self.id = self.__next_index()
 		#     Wishlist.data.append(self)
@@ -125,37 +874,13 @@ class Wishlist(object):
 		#             Wishlist.data[i] = self
 		#             break
 
-	"""
-	It is not yet necessary to be able to add individual wishlist entries
-	as this is accomplished by updating the entire wishlist
-	# method to add a product entry to a wishlist's product list
-	def add_entry(self, wishlist_entry):
-		wishlist_entry.id =  len(self.entries)
-		self.entries.append(wishlist_entry)
-
-	"""
-	@retry(HTTPError, delay=2, backoff=3, tries=5)
 	def delete_wishlist(self):
-		try:
-			document = self.database[self.id]
-		except KeyError:
-			document = None
-		if document:
-			document.delete()
-
-	"""
-	It is not yet necessary to be able to remove individual wishlist entries
-	as this is accomplished by updating the entire wishlist
-
-	# method to delete a product entry from a wishlist's product list
-	def delete_entry(self, ID):
-		for i in self.entries:
-			if i.id == ID:
-				self.entries.remove(i)
-
-	"""
+		"""
+		Deletes the Wishlist at the revision it was read at
+		Returns False if the Wishlist no longer exists
+		"""
+		return Wishlist.delete_by_id(self.id, self.rev)
 
-	@retry(HTTPError, delay=2, backoff=3, tries=5)
 	def deserialize(self, data):
 		"""
 		Deserializes a Wishlist from a dictionary
@@ -176,13 +901,17 @@ class Wishlist(object):
 		# if there is no id and the data has one, assign it
 		if not self.id and '_id' in data:
 			self.id = data['_id']
+		# remember the revision a stored document was read at
+		if '_rev' in data:
+			self.rev = data['_rev']
 
 		return self
 
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
 	def serialize(self):
 		""" Serializes a wishlist into a dictionary """
-		return {"id": self.id, "name": self.name, "user": self.user, "entries": [entry.serialize() for entry in self.entries]}
+		# entries are built inline, a method call per entry dominates long lists
+		return {"id": self.id, "name": self.name, "user": self.user,
+				"entries": [{"id": entry.id, "name": entry.name} for entry in self.entries]}
 
 
 
@@ -191,13 +920,13 @@ class Wishlist(object):
 ######################################################################
 
 	@classmethod
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
+	@storage_retry
 	def connect(cls):
 		""" Connect to the server """
 		cls.client.connect()
 
 	@classmethod
-	@retry(HTTPError, delay=1, backoff=2, tries=5)
+	@storage_retry
 	def disconnect(cls):
 		""" Disconnect from the server """
 		cls.client.disconnect()
@@ -211,22 +940,114 @@ class Wishlist(object):
 	#     return cls.index
 
 	@classmethod
-	@retry(HTTPError, delay=2, backoff=3, tries=5)
-	def remove_all(cls):
-		""" Removes all of the Wishlists from the database """
-		for document in cls.database:
-			document.delete()
+	def remove_all(cls, batch_size=BULK_BATCH_SIZE):
+		""" Removes all of the Wishlists from the database
+
+		Returns the number of wishlists deleted
+		"""
+		deleted = cls.engine.remove({}, batch_size)
+		cls.cache.clear()
+		return deleted
+
+	@classmethod
+	def remove_by_user(cls, wishlist_user, batch_size=BULK_BATCH_SIZE):
+		""" Removes all of a user's Wishlists in batches
+
+		Returns the number of wishlists deleted
+		"""
+		deleted = cls.engine.remove({'user': wishlist_user}, batch_size)
+		cls.cache.clear()
+		return deleted
+
+	@classmethod
+	def bulk_delete(cls, stubs):
+		""" Deletes documents in a single bulk request
+
+		Args:
+			stubs (list): dictionaries holding the _id and _rev to delete
+		Returns the number of documents deleted
+		"""
+		try:
+			return cls.engine.bulk_delete(stubs)
+		finally:
+			for stub in stubs:
+				cls.cache.invalidate(stub['_id'])
+
+	@classmethod
+	def bulk_create(cls, wishlists, batch_size=BULK_BATCH_SIZE):
+		""" Creates Wishlists with batched bulk requests
+
+		Sets the id of every wishlist that was created and returns one
+		(error, message) per wishlist, None when it was created. The error
+		is the one the database reported for the document, such as
+		conflict, or unavailable when its batch could not be written.
+		A failed batch does not stop the batches after it, so the ids of
+		the wishlists already written are never lost.
+		"""
+		errors = []
+		for start in range(0, len(wishlists), batch_size):
+			batch = wishlists[start:start + batch_size]
+			try:
+				results = cls.engine.bulk_create([w.serialize() for w in batch])
+			except (HTTPError, ConnectionError) as err:
+				# DatabaseConnectionError, CircuitOpenError and StorageOverloadError too
+				Wishlist.logger.warning('Bulk create failed: %s', err)
+				error = 'unavailable' if isinstance(err, ConnectionError) or is_transient(err) \
+					else 'error'
+				errors.extend([(error, str(err))] * len(batch))
+				continue
+			for wishlist, result in zip(batch, results):
+				if 'error' in result:
+					errors.append((result['error'], result.get('reason') or result['error']))
+				else:
+					wishlist.id = result['id']
+					wishlist.rev = result['rev']
+					errors.append(None)
+		return errors
 
 	@classmethod
-	@retry(HTTPError, delay=2, backoff=3, tries=5)
 	def all(cls):
 		""" Returns all of the Wishlists in the database """
-		results = []
-		for doc in cls.database:
-			wishlist = Wishlist().deserialize(doc)
-			wishlist.id = doc['_id']
-			results.append(wishlist)
-		return results
+		return list(cls.iterate())
+
+	@classmethod
+	def page(cls, limit, cursor=None, **kwargs):
+		""" Returns one page of Wishlists and the cursor of the next page
+
+		Args:
+			limit (int): the maximum number of wishlists to return
+			cursor (string): the cursor returned along with the previous page
+			kwargs: optional selector the wishlists must match
+		"""
+		documents, next_cursor = cls.engine.query(kwargs, limit, cursor)
+		return [Wishlist().deserialize(doc) for doc in documents], next_cursor
+
+	@classmethod
+	def iterate(cls, batch_size=BULK_BATCH_SIZE, **kwargs):
+		""" Lazily yields Wishlists, fetching them one page at a time
+
+		Args:
+			batch_size (int): the number of wishlists fetched per request
+			kwargs: optional selector the wishlists must match
+		"""
+		for document in cls.engine.iterate(kwargs, batch_size):
+			yield Wishlist().deserialize(document)
+
+	@classmethod
+	def page_projected(cls, limit, cursor=None, **kwargs):
+		""" Returns one page of Wishlists in their response shape and the next cursor
+
+		The stored documents are projected straight into dictionaries,
+		no Wishlist objects are built. Takes the arguments of page.
+		"""
+		documents, next_cursor = cls.engine.query(kwargs, limit, cursor, PROJECTED_FIELDS)
+		return [project_document(document) for document in documents], next_cursor
+
+	@classmethod
+	def iterate_projected(cls, batch_size=BULK_BATCH_SIZE, **kwargs):
+		""" Lazily yields Wishlists in their response shape, see page_projected """
+		for document in cls.engine.iterate(kwargs, batch_size, PROJECTED_FIELDS):
+			yield project_document(document)
 
 
 ######################################################################
@@ -235,24 +1056,169 @@ class Wishlist(object):
 	@classmethod
 	# @retry(HTTPError, delay=1, backoff=5, tries=10)
 	def find_by(cls, **kwargs):
-		""" Find records using selector """
-		query = Query(cls.database, selector=kwargs)
-		results = []
-		for doc in query.result:
-			wishlist = Wishlist()
-			wishlist.deserialize(doc)
-			results.append(wishlist)
-		return results
+		""" Find records using selector
+
+		Every keyword becomes a field of one selector, so several fields
+		are matched together in a single query.
+		"""
+		return list(cls.iterate(**kwargs))
 
 	@classmethod
 	# @retry(HTTPError, delay=1, backoff=5, tries=10)
-	def find(cls, wishlist_id):
-		""" Query that finds Pets by their id """
+	def find(cls, wishlist_id, rev=None, cached=True):
+		""" Query that finds Wishlists by their id, reading through the cache
+
+		Args:
+			wishlist_id (string): the id of the wishlist to find
+			rev (string): the known current revision, a cached document
+				at any other revision is fetched again. Without it a HEAD
+				request reads the current revision before the cached
+				document is served.
+			cached (bool): False always fetches the document from the database
+		"""
+		document = cls._get_document(wishlist_id, rev, cached)
+		if document is None:
+			return None
+		return Wishlist().deserialize(document)
+
+	@classmethod
+	def _get_document(cls, wishlist_id, rev=None, cached=True):
+		""" Reads a document through the cache, None if it does not exist """
+		document = cls.cache.get(wishlist_id) if cached else None
+		if document is not None and not rev:
+			# other workers keep caches of their own and may have changed or
+			# deleted the document since, a HEAD request is cheaper than a GET
+			rev = cls.engine.revision(wishlist_id)
+			if rev is None:
+				cls.cache.invalidate(wishlist_id)
+				return None
+		if document is not None and rev and document['_rev'] != rev:
+			document = None
+		if document is None:
+			document = cls.engine.get(wishlist_id)
+			if document is None:
+				return None
+			cls.cache.put(wishlist_id, document)
+		return document
+
+	@classmethod
+	def _put_document(cls, wishlist_id, rev, body):
+		"""
+		Writes a document at a known revision with a single request
+
+		Returns the new revision, False if the document does not exist
+		and raises a DataConflictError if the revision is not current
+		"""
+		# dropped once the write is done, a find racing the write could
+		# otherwise cache the old document again
 		try:
-			document = cls.database[wishlist_id]
-			return Wishlist().deserialize(document)
-		except KeyError:
+			return cls.engine.update(wishlist_id, rev, body)
+		finally:
+			cls.cache.invalidate(wishlist_id)
+
+	@classmethod
+	def patch(cls, wishlist_id, operations, rev=None):
+		"""
+		Applies JSON Patch (RFC 6902) operations to a stored Wishlist
+
+		Only the name, user and entries can be patched and entries are
+		only validated when an operation touches them. The result is
+		written with the revision that was patched.
+
+		Args:
+			wishlist_id (string): the id of the wishlist to patch
+			operations (list): the JSON Patch operations
+			rev (string): the revision the client expects to patch
+		Returns the patched Wishlist, None if it does not exist
+		"""
+		if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+			raise DataValidationError('Invalid patch: body must be a list of operations')
+		# a cached copy is good enough when it is at the expected revision
+		document = cls._get_document(wishlist_id, rev, cached=bool(rev))
+		if document is None:
+			return None
+		if rev and document['_rev'] != rev:
+			raise DataConflictError('Wishlist {} is not at revision {}'.format(wishlist_id, rev))
+
+		fields = dict((key, document.get(key)) for key in ('name', 'user', 'entries'))
+		try:
+			patched = jsonpatch.apply_patch(fields, operations)
+		except (jsonpatch.JsonPatchException, jsonpatch.JsonPointerException) as err:
+			raise DataValidationError('Invalid patch: ' + str(err))
+		except (KeyError, TypeError):
+			raise DataValidationError('Invalid patch: operations are malformed')
+		if set(patched) != set(fields):
+			raise DataValidationError('Invalid patch: only name, user and entries can be changed')
+		if not patched['name'] or not patched['user']:
+			raise DataValidationError('Invalid patch: name and user are required')
+		if any(str(op.get('path', '')).startswith('/entries') for op in operations):
+			if not isinstance(patched['entries'], list):
+				raise DataValidationError('Invalid patch: entries must be a list')
+			for entry in patched['entries']:
+				Wishlist_entry().deserialize(entry)
+				if not isinstance(entry.get('id'), (int, long)) or isinstance(entry['id'], bool):
+					raise DataValidationError('Invalid patch: every entry needs an integer id')
+
+		document = dict(document)
+		document.update(patched)
+		new_rev = cls._put_document(wishlist_id, document['_rev'], document)
+		if not new_rev:
+			return None
+		document['_rev'] = new_rev
+		return Wishlist().deserialize(document)
+
+	@classmethod
+	def delete_by_id(cls, wishlist_id, rev=None):
+		"""
+		Deletes a Wishlist with a single delete of its revision
+
+		Args:
+			wishlist_id (string): the id of the wishlist to delete
+			rev (string): the revision to delete, looked up first when
+				it is not known
+		Returns False if the Wishlist does not exist
+		"""
+		rev = rev or cls.revision(wishlist_id)
+		if not rev:
+			cls.cache.invalidate(wishlist_id)
+			return False
+		try:
+			return cls.engine.delete(wishlist_id, rev)
+		finally:
+			cls.cache.invalidate(wishlist_id)
+
+	@classmethod
+	def add_entry(cls, wishlist_id, wishlist_entry):
+		"""
+		Appends an entry to a Wishlist without rewriting the whole document
+
+		The entry is assigned the next free id by the storage engine.
+		Returns the entry, or None if the Wishlist does not exist
+		"""
+		try:
+			entry = cls.engine.add_entry(wishlist_id, wishlist_entry.name)
+		finally:
+			cls.cache.invalidate(wishlist_id)
+		if entry is None:
 			return None
+		wishlist_entry.id = entry['id']
+		return wishlist_entry
+
+	@classmethod
+	def delete_entry(cls, wishlist_id, entry_id):
+		"""
+		Removes an entry from a Wishlist without rewriting the whole document
+		Returns False if the Wishlist or the entry does not exist
+		"""
+		try:
+			return cls.engine.delete_entry(wishlist_id, entry_id)
+		finally:
+			cls.cache.invalidate(wishlist_id)
+
+	@classmethod
+	def revision(cls, wishlist_id):
+		""" Returns the current revision of a Wishlist, None if it does not exist """
+		return cls.engine.revision(wishlist_id)
 
 	@classmethod
 	# @retry(HTTPError, delay=1, backoff=5, tries=10)
@@ -274,15 +1240,373 @@ class Wishlist(object):
 		"""
 		return cls.find_by(name=wishlist_name)
 
+	@classmethod
+	def find_by_user_and_name(cls, wishlist_user, wishlist_name):
+		""" Returns a user's wishlists with the given name
+
+		Args:
+			User (string): the owner of the wishlists you want to match
+			Name (string): the name of the wishlist you want to match
+		"""
+		return cls.find_by(user=wishlist_user, name=wishlist_name)
+
 
 
 ############################################################
-#  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
+#  S T O R A G E   E N G I N E   S E L E C T I O N
 ############################################################
 
 	@staticmethod
 	# @retry(HTTPError, delay=1, backoff=30, tries=10)
-	def init_db(dbname='wishlists'):
+	def init_db(dbname='wishlists', engine=None):
+		"""
+		Initialized the storage engine, STORAGE_ENGINE unless one is named
+		"""
+		engine = engine or STORAGE_ENGINE
+		if engine not in STORAGE_ENGINES:
+			raise AssertionError('Unknown storage engine [{}]'.format(engine))
+		Wishlist.logger.info('Opening the %s storage engine', engine)
+		opened = STORAGE_ENGINES[engine].open(dbname)
+		opened.setup()
+		# threads serving requests only ever see a fully set up engine
+		with Wishlist.lock:
+			Wishlist.engine = MeasuredEngine(opened, engine)
+			Wishlist.client = getattr(opened, 'client', None)
+			Wishlist.database = getattr(opened, 'database', None)
+			Wishlist.cache.clear()
+
+	@classmethod
+	def warm_up(cls):
+		""" Opens the connections of the storage engine ahead of the first request """
+		cls.engine.warm_up()
+
+
+######################################################################
+#  S T O R A G E   E N G I N E S
+######################################################################
+
+class StorageEngine(object):
+	"""
+	Interface of the document stores a Wishlist can be kept in
+
+	Documents are dictionaries holding an _id and a _rev. Every write
+	names the revision it replaces and raises a DataConflictError when
+	that revision is no longer current.
+	"""
+	logger = logging.getLogger(__name__)
+
+	@classmethod
+	def open(cls, dbname):
+		""" Returns the engine storing the database called dbname """
+		raise NotImplementedError
+
+	def setup(self):
+		""" Prepares indexes and anything else the engine needs """
+		pass
+
+	def warm_up(self):
+		""" Opens connections and loads indexes so the first request is not slow """
+		pass
+
+	def create(self, document):
+		""" Stores a new document, returns its (id, revision) or None """
+		raise NotImplementedError
+
+	def get(self, doc_id):
+		""" Returns the document with the id, None if it does not exist """
+		raise NotImplementedError
+
+	def revision(self, doc_id):
+		""" Returns the current revision of a document, None if it does not exist """
+		raise NotImplementedError
+
+	def update(self, doc_id, rev, document):
+		""" Replaces revision rev of a document, returns the new revision
+
+		Returns False if the document does not exist
+		"""
+		raise NotImplementedError
+
+	def delete(self, doc_id, rev):
+		""" Deletes revision rev of a document, False if it does not exist """
+		raise NotImplementedError
+
+	def query(self, selector, limit, cursor=None, fields=None):
+		""" Returns a page of the documents matching every field of selector
+
+		Args:
+			selector (dict): field values the documents must equal
+			limit (int): the maximum number of documents to return
+			cursor (string): the cursor returned with the previous page
+			fields (list): only return these fields of the documents,
+				which are then only read and may be shared with the engine
+		Returns the documents and the cursor of the next page, or None
+		"""
+		raise NotImplementedError
+
+	def bulk_create(self, documents):
+		""" Stores new documents, returns one {'id', 'rev'} or {'error'} each """
+		results = []
+		for document in documents:
+			try:
+				doc_id, rev = self.create(document)
+				results.append({'ok': True, 'id': doc_id, 'rev': rev})
+			except DataConflictError as err:
+				results.append({'id': document.get('_id'), 'error': 'conflict', 'reason': str(err)})
+		return results
+
+	def bulk_delete(self, stubs):
+		""" Deletes the _id/_rev stubs, returns the number deleted """
+		raise NotImplementedError
+
+	def iterate(self, selector, batch_size=BULK_BATCH_SIZE, fields=None):
+		""" Lazily yields the documents matching selector, a page at a time """
+		cursor = None
+		while True:
+			documents, cursor = self.query(selector, batch_size, cursor, fields)
+			for document in documents:
+				yield document
+			if not cursor:
+				return
+
+	def remove(self, selector, batch_size=BULK_BATCH_SIZE):
+		""" Deletes every document matching selector, returns how many """
+		deleted = 0
+		while True:
+			stubs, _ = self.query(selector, batch_size, fields=['_id', '_rev'])
+			removed = self.bulk_delete(stubs)
+			deleted += removed
+			# stop when the query is drained or nothing more can be deleted
+			if len(stubs) < batch_size or not removed:
+				return deleted
+
+	def add_entry(self, doc_id, name):
+		""" Appends an entry with the next free id, None if no such document """
+		for _ in range(ENTRY_WRITE_TRIES):
+			document = self.get(doc_id)
+			if document is None:
+				return None
+			entries = document.get('entries') or []
+			entry = {'id': next_entry_id(entries), 'name': name}
+			document['entries'] = entries + [entry]
+			try:
+				if not self.update(doc_id, document['_rev'], document):
+					return None
+				return entry
+			except DataConflictError:
+				continue
+		raise DataConflictError('Wishlist {} kept changing while adding an entry'.format(doc_id))
+
+	def delete_entry(self, doc_id, entry_id):
+		""" Removes an entry, False if the document or the entry does not exist """
+		for _ in range(ENTRY_WRITE_TRIES):
+			document = self.get(doc_id)
+			if document is None:
+				return False
+			entries = document.get('entries') or []
+			kept = [entry for entry in entries if entry.get('id') != entry_id]
+			if len(kept) == len(entries):
+				return False
+			document['entries'] = kept
+			try:
+				return bool(self.update(doc_id, document['_rev'], document))
+			except DataConflictError:
+				continue
+		raise DataConflictError('Wishlist {} kept changing while deleting an entry'.format(doc_id))
+
+
+class MeasuredEngine(object):
+	"""
+	Times the calls the Wishlist model makes to its storage engine
+
+	Each storage operation is recorded in service_metrics by engine,
+	operation and outcome, along with the calls in flight, and in the
+	round trips of the request being served. Calls the engine makes to
+	itself are not recorded again, and any other attribute is read
+	straight from the engine.
+	"""
+	def __init__(self, engine, name, metrics=None, round_trips=None):
+		""" Initialize the wrapper of an opened engine registered as name """
+		self.target = engine
+		self.engine_name = name
+		self.metrics = metrics or service_metrics
+		self.round_trips = round_trips or storage_round_trips
+
+	def __getattr__(self, name):
+		""" Reads an attribute of the engine, timing its storage operations """
+		attribute = getattr(self.target, name)
+		if name in STORAGE_OPERATIONS:
+			attribute = self.measure(name, attribute)
+			# later lookups find the wrapper without calling __getattr__
+			setattr(self, name, attribute)
+		return attribute
+
+	def measure(self, operation, method):
+		""" Wraps an engine method so each call is timed """
+		metrics = self.metrics
+		round_trips = self.round_trips
+		labels = (self.engine_name, operation)
+		if operation == 'iterate':
+			@functools.wraps(method)
+			def iterate(*args, **kwargs):
+				return self.measure_pages(labels, method(*args, **kwargs))
+			return iterate
+
+		@functools.wraps(method)
+		def wrapper(*args, **kwargs):
+			metrics.inc('wishlist_storage_requests_in_flight', labels[:1])
+			start = metrics.timer()
+			outcome = 'error'
+			try:
+				result = method(*args, **kwargs)
+				outcome = 'ok'
+			finally:
+				elapsed = metrics.timer() - start
+				metrics.observe('wishlist_storage_request_duration_seconds',
+								labels + (outcome,), elapsed)
+				metrics.dec('wishlist_storage_requests_in_flight', labels[:1])
+				round_trips.record(operation, elapsed)
+			return result
+		return wrapper
+
+	def measure_pages(self, labels, documents):
+		""" Yields from an engine iterator, timing the pages it fetched as one call """
+		metrics = self.metrics
+		elapsed = 0
+		outcome = 'ok'
+		try:
+			while True:
+				metrics.inc('wishlist_storage_requests_in_flight', labels[:1])
+				start = metrics.timer()
+				try:
+					document = next(documents)
+				except StopIteration:
+					break
+				except Exception:
+					outcome = 'error'
+					raise
+				finally:
+					elapsed += metrics.timer() - start
+					metrics.dec('wishlist_storage_requests_in_flight', labels[:1])
+				yield document
+		finally:
+			metrics.observe('wishlist_storage_request_duration_seconds',
+							labels + (outcome,), elapsed)
+			self.round_trips.record(labels[1], elapsed)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+	"""
+	HTTP adapter whose pooled connections send TCP keep-alive probes
+
+	Idle pooled connections are otherwise silently dropped by load
+	balancers and the next request on them fails.
+	"""
+	def __init__(self, keepalive=CLOUDANT_KEEPALIVE, **kwargs):
+		""" Initialize the adapter, a keepalive of 0 leaves the sockets alone """
+		self.keepalive = keepalive
+		super(KeepAliveAdapter, self).__init__(**kwargs)
+
+	def init_poolmanager(self, *args, **kwargs):
+		""" Adds the keep-alive socket options to every pooled connection """
+		if self.keepalive:
+			options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+			for name, value in (('TCP_KEEPIDLE', self.keepalive),
+								('TCP_KEEPINTVL', max(1, self.keepalive // 4)),
+								('TCP_KEEPCNT', 4)):
+				if hasattr(socket, name):
+					options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+			kwargs['socket_options'] = HTTPConnection.default_socket_options + options
+		super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class PooledCloudant(Cloudant):
+	"""
+	Cloudant client that gives every thread its own session
+
+	A requests session, and the cookie renewal of a Cloudant session, are
+	not safe to share between threads, so each thread logs in once with
+	a session of its own. Every session is mounted on the same adapter,
+	so all threads share one bounded pool of keep-alive connections.
+	Only connect posts to _session, the sessions of the other threads
+	start with a copy of its cookie and log in again only once it has
+	expired. Greenlets never run at the same time, so under gevent they
+	share one session rather than logging in once per request. Every
+	response a session receives is recorded in storage_round_trips.
+	"""
+	def __init__(self, *args, **kwargs):
+		""" Initialize the client, connect=True logs in the calling thread """
+		self.sessions = SharedLocal() if is_cooperative() else threading.local()
+		self.generation = 0
+		self.connected = False
+		# the session logged in by connect, whose cookie other threads reuse
+		self.seed = None
+		super(PooledCloudant, self).__init__(*args, **kwargs)
+
+	@property
+	def r_session(self):
+		""" The session of the calling thread, logged in on first use """
+		if getattr(self.sessions, 'generation', None) != self.generation:
+			self.sessions.session = None
+			self.sessions.generation = self.generation
+			if self.connected:
+				super(PooledCloudant, self).connect()
+		return self.sessions.session
+
+	@r_session.setter
+	def r_session(self, session):
+		if session is not None:
+			session.hooks['response'].append(self.record_round_trip)
+		self.sessions.session = session
+		self.sessions.generation = self.generation
+
+	@staticmethod
+	def record_round_trip(response, *args, **kwargs):  # pylint: disable=unused-argument
+		""" Records a response in the round trips of the request being served """
+		storage_round_trips.record_http(response.request.method,
+										response.elapsed.total_seconds())
+
+	def connect(self):
+		""" Logs the calling thread in, other threads reuse its cookie on their first request """
+		self.generation += 1
+		self.connected = True
+		self.seed = None
+		self.sessions.generation = self.generation
+		self.sessions.session = None
+		super(PooledCloudant, self).connect()
+		self.seed = self.sessions.session
+
+	def disconnect(self):
+		""" Logs the calling thread out and drops the sessions of every thread """
+		super(PooledCloudant, self).disconnect()
+		self.connected = False
+		self.seed = None
+		self.generation += 1
+
+	def session_login(self, user=None, passwd=None):
+		""" Logs the session of the calling thread in with the cookie of connect if it has one """
+		seed = self.seed
+		if user is not None or seed is None or not seed.cookies:
+			return super(PooledCloudant, self).session_login(user, passwd)
+		self.r_session.cookies.update(seed.cookies)
+
+
+class CloudantEngine(StorageEngine):
+	"""
+	Keeps Wishlists as documents of a Cloudant or CouchDB database
+
+	Requests wait for a slot of storage_limiter and then go through
+	storage_breaker, which only times the request itself. Idempotent
+	requests are retried by storage_retry, creates and entry updates are
+	not as a retry could apply them twice.
+	"""
+	def __init__(self, client, database):
+		""" Initialize the engine on a connected client and database """
+		self.client = client
+		self.database = database
+
+	@classmethod
+	def open(cls, dbname):
 		"""
 		Initialized Coundant database connection
 		"""
@@ -290,15 +1614,15 @@ class Wishlist(object):
 		vcap_services = {}
 		# Try and get VCAP from the environment or a file if developing
 		if 'VCAP_SERVICES' in os.environ:
-			Wishlist.logger.info('Running in Bluemix mode.')
+			cls.logger.info('Running in Bluemix mode.')
 			vcap_services = json.loads(os.environ['VCAP_SERVICES'])
 		# if VCAP_SERVICES isn't found, maybe we are running on Kubernetes?
 		elif 'BINDING_CLOUDANT' in os.environ:
-			Wishlist.logger.info('Found Kubernetes Bindings')
+			cls.logger.info('Found Kubernetes Bindings')
 			creds = json.loads(os.environ['BINDING_CLOUDANT'])
 			vcap_services = {"cloudantNoSQLDB": [{"credentials": creds}]}
 		else:
-			Wishlist.logger.info('VCAP_SERVICES and BINDING_CLOUDANT undefined.')
+			cls.logger.info('VCAP_SERVICES and BINDING_CLOUDANT undefined.')
 			creds = {
 				"username": CLOUDANT_USERNAME,
 				"password": CLOUDANT_PASSWORD,
@@ -319,30 +1643,807 @@ class Wishlist(object):
 				opts['url'] = cloudant_service['credentials']['url']
 
 		if any(k not in opts for k in ('host', 'username', 'password', 'port', 'url')):
-			Wishlist.logger.info('Error - Failed to retrieve options. ' \
+			cls.logger.info('Error - Failed to retrieve options. ' \
 							 'Check that app is bound to a Cloudant service.')
 			exit(-1)
 
-		Wishlist.logger.info('Cloudant Endpoint: %s', opts['url'])
+		cls.logger.info('Cloudant Endpoint: %s', opts['url'])
 		try:
 			if ADMIN_PARTY:
-				Wishlist.logger.info('Running in Admin Party Mode...')
-			Wishlist.client = Cloudant(opts['username'],
-								  opts['password'],
-								  url=opts['url'],
-								  connect=True,
-								  auto_renew=True,
-								  admin_party=ADMIN_PARTY
-								 )
+				cls.logger.info('Running in Admin Party Mode...')
+			client = PooledCloudant(opts['username'],
+									opts['password'],
+									url=opts['url'],
+									connect=True,
+									auto_renew=True,
+									admin_party=ADMIN_PARTY,
+									adapter=KeepAliveAdapter(pool_connections=1,
+															 pool_maxsize=CLOUDANT_POOL_SIZE,
+															 pool_block=True)
+								   )
 		except ConnectionError:
 			raise AssertionError('Cloudant service could not be reached')
 
 		# Create database if it doesn't exist
 		try:
-			Wishlist.database = Wishlist.client[dbname]
+			database = client[dbname]
 		except KeyError:
 			# Create a database using an initialized client
-			Wishlist.database = Wishlist.client.create_database(dbname)
+			database = client.create_database(dbname)
 		# check for success
-		if not Wishlist.database.exists():
-			raise AssertionError('Database [{}] could not be obtained'.format(dbname))
\ No newline at end of file
+		if not database.exists():
+			raise AssertionError('Database [{}] could not be obtained'.format(dbname))
+		return cls(client, database)
+
+	def setup(self):
+		""" Reconciles the Mango indexes and installs the update handlers """
+		self.ensure_indexes()
+		self.ensure_update_handlers()
+
+	def warm_up(self):
+		""" Opens a pooled connection and runs one query per index """
+		self.database.exists()
+		for _, fields in QUERY_INDEXES:
+			self.query(dict((field, '') for field in fields), 1)
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def ensure_update_handlers(self):
+		""" Installs the entry update handlers if they are missing or changed """
+		document = Document(self.database, ENTRY_HANDLERS_DDOC)
+		if document.exists():
+			document.fetch()
+		if document.get('updates') != ENTRY_HANDLERS:
+			self.logger.info('Installing update handlers %s', ENTRY_HANDLERS_DDOC)
+			document['updates'] = ENTRY_HANDLERS
+			document.save()
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def ensure_indexes(self):
+		""" Creates the declared Mango indexes and drops stale ones """
+		existing = {}
+		for index in self.database.get_query_indexes(raw_result=True)['indexes']:
+			ddoc = (index.get('ddoc') or '').replace('_design/', '', 1)
+			if ddoc.startswith(INDEX_PREFIX):
+				existing[ddoc] = [list(field)[0] for field in index['def']['fields']]
+
+		declared = dict(QUERY_INDEXES)
+		for ddoc, fields in list(existing.items()):
+			if declared.get(ddoc) != fields:
+				self.logger.info('Dropping stale index %s on %s', ddoc, fields)
+				self.database.delete_query_index(ddoc, 'json', ddoc)
+				del existing[ddoc]
+
+		for ddoc, fields in QUERY_INDEXES:
+			if ddoc not in existing:
+				self.logger.info('Creating index %s on %s', ddoc, fields)
+				self.database.create_query_index(design_document_id=ddoc,
+												 index_name=ddoc,
+												 fields=fields)
+
+	@storage_limiter
+	@storage_breaker
+	def create(self, document):
+		""" Stores a new document with the client """
+		created = self.database.create_document(document)
+		# the database keeps every document it creates, which would leak
+		dict.pop(self.database, created['_id'], None)
+		if not created.exists():
+			return None
+		return created['_id'], created['_rev']
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def get(self, doc_id):
+		""" Fetches a document, None on a 404 """
+		document = Document(self.database, doc_id)
+		try:
+			document.fetch()
+		except HTTPError as err:
+			if err.response is not None and err.response.status_code == 404:
+				return None
+			raise
+		return dict(document)
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def revision(self, doc_id):
+		""" Reads the revision from the ETag of a HEAD request """
+		document = Document(self.database, doc_id)
+		resp = self.database.r_session.head(document.document_url)
+		if resp.status_code == 404:
+			return None
+		resp.raise_for_status()
+		return resp.headers['ETag'].strip('"')
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def update(self, doc_id, rev, document):
+		""" Writes the revision back with a single PUT """
+		body = dict(document, _id=doc_id, _rev=rev)
+		resp = self.database.r_session.put(Document(self.database, doc_id).document_url,
+										   data=json.dumps(body),
+										   headers={'Content-Type': 'application/json'})
+		if resp.status_code == 409:
+			return self._conflict(doc_id, rev)
+		resp.raise_for_status()
+		return resp.json()['rev']
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def delete(self, doc_id, rev):
+		""" Deletes the revision with a single DELETE """
+		resp = self.database.r_session.delete(Document(self.database, doc_id).document_url,
+											  params={'rev': rev})
+		if resp.status_code == 404:
+			return False
+		if resp.status_code == 409:
+			return self._conflict(doc_id, rev)
+		resp.raise_for_status()
+		return True
+
+	def _conflict(self, doc_id, rev):
+		""" Explains a 409 from a write: False when missing, else DataConflictError """
+		if self.revision(doc_id) is None:
+			self.logger.warning('Write failed: %s not found', doc_id)
+			return False
+		raise DataConflictError('Wishlist {} was changed since revision {}'.format(doc_id, rev))
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def query(self, selector, limit, cursor=None, fields=None):
+		""" Pages through _all_docs or, with a selector, a Mango query """
+		if selector:
+			return self._page_by_query(selector, limit, cursor, fields)
+		return self._page_all_docs(limit, cursor)
+
+	def _page_all_docs(self, limit, cursor):
+		""" Pages through _all_docs keyed on the document id """
+		params = {'include_docs': True, 'limit': limit + 1}
+		if cursor:
+			params['startkey'] = cursor
+		rows = self.database.all_docs(**params)['rows']
+		next_cursor = None
+		if len(rows) > limit:
+			next_cursor = rows[limit]['id']
+			rows = rows[:limit]
+		documents = [row['doc'] for row in rows if not is_design_document(row['doc'])]
+		return documents, next_cursor
+
+	def _page_by_query(self, selector, limit, cursor, fields):
+		""" Pages through a Mango query using its bookmark """
+		options = index_options(selector)
+		if fields:
+			options['fields'] = fields
+		query = Query(self.database, selector=selector, limit=limit, **options)
+		if not cursor:
+			response = query()
+		else:
+			try:
+				response = query(bookmark=cursor)
+			except HTTPError as err:
+				# CouchDB answers 400 invalid_bookmark to a cursor it did not hand out
+				if err.response is None or err.response.status_code != 400:
+					raise
+				raise DataValidationError('Invalid cursor: {}'.format(cursor))
+		documents = response['docs']
+		next_cursor = None
+		if len(documents) == limit:
+			next_cursor = response.get('bookmark')
+		return documents, next_cursor
+
+	@storage_limiter
+	@storage_breaker
+	def bulk_create(self, documents):
+		""" Creates the documents with one _bulk_docs request """
+		return self.database.bulk_docs(documents)
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def bulk_delete(self, stubs):
+		""" Deletes the documents with one _bulk_docs request """
+		if not stubs:
+			return 0
+		results = self.database.bulk_docs([
+			{'_id': stub['_id'], '_rev': stub['_rev'], '_deleted': True}
+			for stub in stubs])
+		failed = [result for result in results if 'error' in result]
+		for result in failed:
+			self.logger.warning('Delete of %s failed: %s', result.get('id'), result['error'])
+		return len(results) - len(failed)
+
+	def remove(self, selector, batch_size=BULK_BATCH_SIZE):
+		""" Deletes with _bulk_docs, walking _all_docs when there is no selector """
+		if selector:
+			return super(CloudantEngine, self).remove(selector, batch_size)
+		deleted = 0
+		for stubs in self._all_doc_stubs(batch_size):
+			deleted += self.bulk_delete(stubs)
+		return deleted
+
+	def _all_doc_stubs(self, batch_size):
+		""" Yields batches of _id/_rev stubs of every Wishlist """
+		params = {'limit': batch_size}
+		while True:
+			rows = self._all_docs_page(params)
+			drained = len(rows) < params['limit']
+			# the start key is inclusive, it was already handled last batch
+			if rows and rows[0]['id'] == params.get('startkey'):
+				rows = rows[1:]
+			if not rows:
+				return
+			yield [{'_id': row['id'], '_rev': row['value']['rev']}
+				   for row in rows if not row['id'].startswith('_design/')]
+			if drained:
+				return
+			params['startkey'] = rows[-1]['id']
+			params['limit'] = batch_size + 1
+
+	@storage_retry
+	@storage_limiter
+	@storage_breaker
+	def _all_docs_page(self, params):
+		""" Reads one page of _all_docs rows """
+		return self.database.all_docs(**params)['rows']
+
+	@storage_limiter
+	@storage_breaker
+	def add_entry(self, doc_id, name):
+		""" Appends an entry with the add_entry update handler """
+		url = update_handler_url(self.database, 'add_entry', doc_id)
+		resp = self._run_handler(url, data=json.dumps({'name': name}),
+								 headers={'Content-Type': 'application/json'})
+		if resp.status_code == 404:
+			return None
+		return resp.json()
+
+	@storage_limiter
+	@storage_breaker
+	def delete_entry(self, doc_id, entry_id):
+		""" Removes an entry with the delete_entry update handler """
+		url = update_handler_url(self.database, 'delete_entry', doc_id)
+		resp = self._run_handler(url, params={'entry_id': entry_id})
+		if resp.status_code == 404:
+			return False
+		return True
+
+	def _run_handler(self, url, **kwargs):
+		"""
+		Runs an update handler, again while it conflicts with another write
+
+		A 409 means nothing was written, so the handler is run again on
+		the current document, up to ENTRY_WRITE_TRIES times.
+		"""
+		for _ in range(ENTRY_WRITE_TRIES):
+			resp = self.database.r_session.put(url, **kwargs)
+			if resp.status_code != 409:
+				if resp.status_code != 404:
+					resp.raise_for_status()
+				return resp
+		raise DataConflictError('Wishlist kept changing while its entries were written')
+
+
+class MemoryEngine(StorageEngine):
+	"""
+	Keeps Wishlists in process memory
+
+	Documents are held in a dict keyed by id, next to a sorted list of
+	the ids that cursors page through and dict based secondary indexes
+	from each value of user and name to the ids holding it. Selectors
+	may only test fields for equality.
+	"""
+	indexed_fields = ('user', 'name')
+	# the open databases by name, shared like a database server would be
+	databases = {}
+	databases_lock = threading.Lock()
+
+	def __init__(self):
+		""" Initialize an empty database """
+		self.lock = threading.RLock()
+		self.documents = {}
+		self.ids = []
+		self.indexes = dict((field, {}) for field in self.indexed_fields)
+
+	@classmethod
+	def open(cls, dbname):
+		""" Returns the in-memory database called dbname, creating it if needed """
+		with cls.databases_lock:
+			if dbname not in cls.databases:
+				cls.databases[dbname] = cls()
+			return cls.databases[dbname]
+
+	def create(self, document):
+		""" Stores a deep copy of the document under a new id """
+		with self.lock:
+			doc_id = document.get('_id') or uuid.uuid4().hex
+			if doc_id in self.documents:
+				raise DataConflictError('Wishlist {} already exists'.format(doc_id))
+			stored = copy.deepcopy(document)
+			stored.update({'_id': doc_id, '_rev': next_revision(None)})
+			self._store(stored)
+			return doc_id, stored['_rev']
+
+	def get(self, doc_id):
+		""" Returns a deep copy of the document """
+		# stored documents are replaced on write, never changed in place
+		document = self.documents.get(doc_id)
+		return copy.deepcopy(document) if document else None
+
+	def revision(self, doc_id):
+		""" Returns the revision of the stored document """
+		document = self.documents.get(doc_id)
+		return document['_rev'] if document else None
+
+	def update(self, doc_id, rev, document):
+		""" Replaces the document if it is still at revision rev """
+		with self.lock:
+			current = self.documents.get(doc_id)
+			if current is None:
+				return False
+			if current['_rev'] != rev:
+				raise DataConflictError('Wishlist {} was changed since revision {}'.format(doc_id, rev))
+			stored = copy.deepcopy(document)
+			stored.update({'_id': doc_id, '_rev': next_revision(rev)})
+			self._store(stored)
+			return stored['_rev']
+
+	def delete(self, doc_id, rev):
+		""" Deletes the document if it is still at revision rev """
+		with self.lock:
+			current = self.documents.get(doc_id)
+			if current is None:
+				return False
+			if current['_rev'] != rev:
+				raise DataConflictError('Wishlist {} was changed since revision {}'.format(doc_id, rev))
+			self._unindex(current)
+			del self.documents[doc_id]
+			del self.ids[bisect_left(self.ids, doc_id)]
+			return True
+
+	def query(self, selector, limit, cursor=None, fields=None):
+		""" Pages in id order through the ids the indexes select """
+		with self.lock:
+			ids = self._candidates(selector)
+			position = bisect_left(ids, cursor) if cursor else 0
+			matches = []
+			for doc_id in ids[position:]:
+				document = self.documents[doc_id]
+				if all(document.get(field) == value for field, value in selector.items()):
+					if len(matches) == limit:
+						return self._project(matches, fields), doc_id
+					matches.append(document)
+			return self._project(matches, fields), None
+
+	def bulk_delete(self, stubs):
+		""" Deletes each stub that is still current """
+		deleted = 0
+		for stub in stubs:
+			try:
+				if self.delete(stub['_id'], stub['_rev']):
+					deleted += 1
+			except DataConflictError as err:
+				self.logger.warning('Delete of %s failed: %s', stub['_id'], err)
+		return deleted
+
+	def _candidates(self, selector):
+		""" Returns the sorted ids of the documents the indexes allow """
+		indexed = [field for field in self.indexed_fields if field in selector]
+		if not indexed:
+			return self.ids
+		ids = None
+		for field in indexed:
+			try:
+				found = self.indexes[field].get(selector[field], set())
+			except TypeError:
+				raise DataValidationError('Invalid selector: {} must be a plain value'.format(field))
+			ids = found if ids is None else ids & found
+		return sorted(ids)
+
+	def _store(self, document):
+		""" Stores a document and keeps the id list and indexes current """
+		doc_id = document['_id']
+		current = self.documents.get(doc_id)
+		if current is None:
+			insort(self.ids, doc_id)
+		else:
+			self._unindex(current)
+		self.documents[doc_id] = document
+		for field, index in self.indexes.items():
+			try:
+				index.setdefault(document.get(field), set()).add(doc_id)
+			except TypeError:
+				pass    # unhashable values can only be found by a scan
+
+	def _unindex(self, document):
+		""" Drops a document from the secondary indexes """
+		for field, index in self.indexes.items():
+			try:
+				ids = index.get(document.get(field))
+			except TypeError:
+				continue
+			if ids:
+				ids.discard(document['_id'])
+				if not ids:
+					del index[document.get(field)]
+
+	@staticmethod
+	def _project(documents, fields):
+		""" Returns deep copies of the documents, or the given fields shallowly """
+		if fields:
+			return [dict((field, document[field]) for field in fields if field in document)
+					for document in documents]
+		return [copy.deepcopy(document) for document in documents]
+
+
+class SQLiteEngine(StorageEngine):
+	"""
+	Keeps Wishlists in an embedded SQLite database
+
+	Wishlists and their entries live in normalized tables with B-tree
+	indexes on the fields the finders select on. The database runs in
+	WAL mode so readers never wait for the writer, and bulk writes are
+	batched into a single transaction.
+	"""
+	metadata = MetaData()
+	wishlists = Table(
+		'wishlists', metadata,
+		Column('id', String(32), primary_key=True),
+		Column('rev', String(64), nullable=False),
+		Column('name', String, nullable=False),
+		Column('user', String, nullable=False),
+		*(Index(ddoc, *fields) for ddoc, fields in QUERY_INDEXES)
+	)
+	entries = Table(
+		'entries', metadata,
+		Column('wishlist_id', String(32),
+			   ForeignKey('wishlists.id', ondelete='CASCADE'), primary_key=True),
+		Column('position', Integer, primary_key=True, autoincrement=False),
+		Column('entry_id', Integer),
+		Column('name', String)
+	)
+	# the open databases by file, sharing one connection pool each
+	databases = {}
+	databases_lock = threading.Lock()
+
+	def __init__(self, db):
+		""" Initialize the engine on a SQLAlchemy engine """
+		self.db = db
+
+	@classmethod
+	def open(cls, dbname):
+		""" Returns the engine for dbname.db in SQLITE_DIR """
+		path = os.path.join(SQLITE_DIR, dbname + '.db')
+		with cls.databases_lock:
+			if path not in cls.databases:
+				cls.logger.info('Opening SQLite database %s', path)
+				db = create_engine('sqlite:///' + path, poolclass=QueuePool,
+								   connect_args={'check_same_thread': False})
+				event.listen(db, 'connect', configure_sqlite_connection)
+				cls.databases[path] = cls(db)
+			return cls.databases[path]
+
+	def setup(self):
+		""" Creates the tables and indexes that are missing """
+		self.metadata.create_all(self.db)
+
+	def warm_up(self):
+		""" Opens a pooled connection and reads the schema into the page cache """
+		self.query({'user': ''}, 1)
+
+	def create(self, document):
+		""" Inserts the wishlist and its entries in one transaction """
+		doc_id = document.get('_id') or uuid.uuid4().hex
+		rev = next_revision(None)
+		try:
+			with self.db.begin() as conn:
+				conn.execute(self.wishlists.insert(), wishlist_row(doc_id, rev, document))
+				self._insert_entries(conn, entry_rows(doc_id, document))
+		except IntegrityError:
+			raise DataConflictError('Wishlist {} already exists'.format(doc_id))
+		return doc_id, rev
+
+	def get(self, doc_id):
+		""" Reads the wishlist row and its entries """
+		with self.db.connect() as conn:
+			documents = self._documents(conn, [conn.execute(
+				self.wishlists.select().where(self.wishlists.c.id == doc_id)).first()])
+		return documents[0] if documents else None
+
+	def revision(self, doc_id):
+		""" Reads only the revision column """
+		return self.db.execute(select([self.wishlists.c.rev]).where(
+			self.wishlists.c.id == doc_id)).scalar()
+
+	def update(self, doc_id, rev, document):
+		""" Replaces the wishlist if it is still at revision rev """
+		new_rev = next_revision(rev)
+		with self.db.begin() as conn:
+			if not self._bump(conn, doc_id, rev, new_rev, document):
+				return self._conflict(conn, doc_id, rev)
+			conn.execute(self.entries.delete().where(self.entries.c.wishlist_id == doc_id))
+			self._insert_entries(conn, entry_rows(doc_id, document))
+		return new_rev
+
+	def delete(self, doc_id, rev):
+		""" Deletes the wishlist if it is still at revision rev, entries cascade """
+		table = self.wishlists
+		with self.db.begin() as conn:
+			result = conn.execute(table.delete().where(
+				and_(table.c.id == doc_id, table.c.rev == rev)))
+			if not result.rowcount:
+				return self._conflict(conn, doc_id, rev)
+		return True
+
+	def query(self, selector, limit, cursor=None, fields=None):
+		""" Seeks the user and name indexes, paging in id order """
+		table = self.wishlists
+		statement = table.select().where(self._where(selector)) \
+			.order_by(table.c.id).limit(limit + 1)
+		if cursor:
+			statement = statement.where(table.c.id >= cursor)
+		with self.db.connect() as conn:
+			rows = conn.execute(statement).fetchall()
+			next_cursor = None
+			if len(rows) > limit:
+				next_cursor = rows[limit].id
+				rows = rows[:limit]
+			if fields and 'entries' not in fields:
+				documents = [project_row(row, fields) for row in rows]
+			else:
+				documents = self._documents(conn, rows)
+		return documents, next_cursor
+
+	def bulk_create(self, documents):
+		""" Inserts all of the documents with one transaction """
+		results = []
+		wishlist_rows = []
+		all_entry_rows = []
+		for document in documents:
+			doc_id = document.get('_id') or uuid.uuid4().hex
+			rev = next_revision(None)
+			wishlist_rows.append(wishlist_row(doc_id, rev, document))
+			all_entry_rows.extend(entry_rows(doc_id, document))
+			results.append({'ok': True, 'id': doc_id, 'rev': rev})
+		if not wishlist_rows:
+			return results
+		try:
+			with self.db.begin() as conn:
+				conn.execute(self.wishlists.insert(), wishlist_rows)
+				self._insert_entries(conn, all_entry_rows)
+		except IntegrityError:
+			# a document named an id that is taken, so create them one by one
+			return super(SQLiteEngine, self).bulk_create(documents)
+		return results
+
+	def bulk_delete(self, stubs):
+		""" Deletes the stubs that are still current with one transaction """
+		if not stubs:
+			return 0
+		table = self.wishlists
+		with self.db.begin() as conn:
+			result = conn.execute(
+				table.delete().where(and_(table.c.id == bindparam('doc_id'),
+										  table.c.rev == bindparam('doc_rev'))),
+				[{'doc_id': stub['_id'], 'doc_rev': stub['_rev']} for stub in stubs])
+		if result.rowcount < len(stubs):
+			self.logger.warning('Delete of %d documents failed', len(stubs) - result.rowcount)
+		return result.rowcount
+
+	def remove(self, selector, batch_size=BULK_BATCH_SIZE):
+		""" Deletes every matching wishlist with a single statement """
+		with self.db.begin() as conn:
+			return conn.execute(self.wishlists.delete().where(self._where(selector))).rowcount
+
+	def add_entry(self, doc_id, name):
+		""" Inserts a single entry row and bumps the revision """
+		for _ in range(ENTRY_WRITE_TRIES):
+			rev = self.revision(doc_id)
+			if rev is None:
+				return None
+			with self.db.begin() as conn:
+				if not self._bump(conn, doc_id, rev, next_revision(rev)):
+					continue
+				last = conn.execute(select([
+					func.max(self.entries.c.entry_id), func.max(self.entries.c.position)
+				]).where(self.entries.c.wishlist_id == doc_id)).first()
+				entry = {'id': next_id(last[0]), 'name': name}
+				conn.execute(self.entries.insert(), wishlist_id=doc_id,
+							 position=next_id(last[1]), entry_id=entry['id'], name=name)
+			return entry
+		raise DataConflictError('Wishlist {} kept changing while adding an entry'.format(doc_id))
+
+	def delete_entry(self, doc_id, entry_id):
+		""" Deletes a single entry row and bumps the revision """
+		for _ in range(ENTRY_WRITE_TRIES):
+			rev = self.revision(doc_id)
+			if rev is None:
+				return False
+			with self.db.connect() as conn, conn.begin() as transaction:
+				if not self._bump(conn, doc_id, rev, next_revision(rev)):
+					continue
+				deleted = conn.execute(self.entries.delete().where(and_(
+					self.entries.c.wishlist_id == doc_id,
+					self.entries.c.entry_id == entry_id))).rowcount
+				if not deleted:
+					# leave the revision alone when nothing changed
+					transaction.rollback()
+					return False
+			return True
+		raise DataConflictError('Wishlist {} kept changing while deleting an entry'.format(doc_id))
+
+	def _bump(self, conn, doc_id, rev, new_rev, document=None):
+		""" Moves a wishlist row from rev to new_rev, False if rev is not current """
+		values = {'rev': new_rev}
+		if document is not None:
+			values.update(name=document.get('name'), user=document.get('user'))
+		table = self.wishlists
+		return conn.execute(table.update().where(
+			and_(table.c.id == doc_id, table.c.rev == rev)).values(**values)).rowcount
+
+	def _conflict(self, conn, doc_id, rev):
+		""" Explains a write that matched no row: False when missing, else DataConflictError """
+		exists = conn.execute(select([self.wishlists.c.id]).where(
+			self.wishlists.c.id == doc_id)).first()
+		if exists is None:
+			self.logger.warning('Write failed: %s not found', doc_id)
+			return False
+		raise DataConflictError('Wishlist {} was changed since revision {}'.format(doc_id, rev))
+
+	def _where(self, selector):
+		""" Returns the clause matching every field of selector """
+		clauses = []
+		for field, value in selector.items():
+			if field not in ('user', 'name') or isinstance(value, (dict, list)):
+				raise DataValidationError('Invalid selector: {} cannot be matched'.format(field))
+			clauses.append(self.wishlists.c[field] == value)
+		return and_(*clauses) if clauses else true()
+
+	def _documents(self, conn, rows):
+		""" Builds documents from wishlist rows, reading all their entries at once """
+		rows = [row for row in rows if row is not None]
+		if not rows:
+			return []
+		documents = OrderedDict((row.id, {
+			'_id': row.id, '_rev': row.rev, 'name': row.name, 'user': row.user, 'entries': []
+		}) for row in rows)
+		table = self.entries
+		for entry in conn.execute(table.select().where(table.c.wishlist_id.in_(list(documents)))
+								  .order_by(table.c.wishlist_id, table.c.position)):
+			documents[entry.wishlist_id]['entries'].append({'id': entry.entry_id, 'name': entry.name})
+		return list(documents.values())
+
+	def _insert_entries(self, conn, rows):
+		""" Inserts entry rows with a single executemany """
+		if rows:
+			conn.execute(self.entries.insert(), rows)
+
+
+# Storage engines Wishlist.init_db can open, by name
+STORAGE_ENGINES = {
+	'cloudant': CloudantEngine,
+	'memory': MemoryEngine,
+	'sqlite': SQLiteEngine
+}
+
+
+def index_options(selector):
+	""" Returns the Query options that pin a selector to its index """
+	for ddoc, fields in QUERY_INDEXES:
+		if set(fields) == set(selector):
+			return {'use_index': ddoc}
+	return {}
+
+
+def update_handler_url(database, handler, document_id):
+	""" Returns the URL that runs an entry update handler on a document """
+	return '/'.join((database.database_url, ENTRY_HANDLERS_DDOC, '_update',
+					 handler, quote(document_id, safe='')))
+
+
+def next_entry_id(entries):
+	""" Returns the id after the highest entry id """
+	return max([entry.get('id', -1) for entry in entries] + [-1]) + 1
+
+
+def next_id(last):
+	""" Returns the id after last, 0 when there is none """
+	return 0 if last is None else last + 1
+
+
+def next_revision(rev):
+	""" Returns a CouchDB style revision that follows rev """
+	generation = int(rev.split('-', 1)[0]) if rev else 0
+	return '{}-{}'.format(generation + 1, uuid.uuid4().hex)
+
+
+def wishlist_row(doc_id, rev, document):
+	""" Returns the wishlists table row of a document """
+	return {'id': doc_id, 'rev': rev, 'name': document.get('name'), 'user': document.get('user')}
+
+
+def entry_rows(doc_id, document):
+	""" Returns the entries table rows of a document, in order """
+	return [{'wishlist_id': doc_id, 'position': position,
+			 'entry_id': entry.get('id'), 'name': entry.get('name')}
+			for position, entry in enumerate(document.get('entries') or [])]
+
+
+def project_row(row, fields):
+	""" Returns the requested fields of a wishlists table row as a document """
+	document = {'_id': row.id, '_rev': row.rev, 'name': row.name, 'user': row.user}
+	return dict((field, document[field]) for field in fields if field in document)
+
+
+def configure_sqlite_connection(connection, _):
+	""" Runs SQLite in WAL mode with enforced foreign keys on every connection """
+	cursor = connection.cursor()
+	cursor.execute('PRAGMA journal_mode=WAL')
+	cursor.execute('PRAGMA synchronous=NORMAL')
+	cursor.execute('PRAGMA foreign_keys=ON')
+	cursor.close()
+
+
+def project_document(document):
+	""" Projects a stored document into the response shape of a Wishlist """
+	return {
+		'id': document['_id'],
+		'name': document.get('name'),
+		'user': document.get('user'),
+		'entries': [{'id': entry.get('id'), 'name': entry.get('name')}
+					for entry in document.get('entries') or []]
+	}
+
+
+def is_transient(error):
+	""" Checks if a storage error may go away when the call is retried """
+	if isinstance(error, HTTPError):
+		return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+	# a DatabaseConnectionError has already been retried
+	return isinstance(error, ConnectionError) and not isinstance(error, DatabaseConnectionError)
+
+
+def retry_after(error):
+	""" Returns the seconds a response asked to wait in Retry-After, or 0 """
+	response = getattr(error, 'response', None)
+	try:
+		return float(response.headers['Retry-After'])
+	except (AttributeError, KeyError, TypeError, ValueError):
+		return 0
+
+
+def add_values(totals, values):
+	""" Adds metric values recorded by one thread to totals """
+	for key, value in values.items():
+		if not isinstance(value, list):
+			totals[key] = totals.get(key, 0) + value
+		elif key in totals:
+			totals[key] = [total + count for total, count in zip(totals[key], value)]
+		else:
+			totals[key] = list(value)
+
+
+def sample_line(name, pairs, value):
+	""" Formats one sample of the Prometheus text format """
+	labels = ','.join('{}="{}"'.format(label, escape_label(text)) for label, text in pairs)
+	if isinstance(value, float):
+		value = repr(value)
+	return '{}{{{}}} {}'.format(name, labels, value) if labels else '{} {}'.format(name, value)
+
+
+def escape_label(text):
+	""" Escapes a label value of the Prometheus text format """
+	return unicode(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def is_design_document(document):
+	""" Checks if a document is a design document rather than a Wishlist """
+	return document['_id'].startswith('_design/')
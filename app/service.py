@@ -4,27 +4,73 @@ Wishlist services
 Paths:
 -----
 GET /healthcheck -- Check heart beat
-GET  /wishlists/ - Retrieves a list of wishlists from the database
+GET /readiness -- Reports whether the warm-up has finished and traffic can be served
+GET /stats -- Reports the counters of the Wishlist cache, storage retries, the
+                        database circuit breaker and the storage concurrency limit
+GET /metrics -- Reports request and storage latency histograms, counters and
+                        in-flight gauges in the Prometheus text format
+GET  /wishlists/ - Retrieves the first page of wishlists from the database
 GET  /wishlists/{wishlist_id}/items - Retrieves a Wishlist with a specific id
 GET /wishlists?wishlist_user="username" - Retrieves the list of wishlists for a user
 GET /wishlists?wishlist_user="username"&wishlist_name="wishlistname" 
                         - Retrieves the list of wishlists that match a name for a user
+GET /wishlists?limit=20&cursor="cursor" - Retrieves one page of wishlists, the next
+                        page is advertised in the Link and X-Next-Cursor headers
+GET /wishlists?stream=true - Streams the list of wishlists as it is read from the
+                        database, send Accept: application/x-ndjson for one per line
 POST /wishlists - Creates a Wishlist in the datbase from the posted database
-PUT  /wishlists/{id} - Updates a Wishlist in the database fom the posted database
-DELETE /wishlists/{wishlist_id} - Removes a Wishlist from the database that matches the id
+POST /wishlists/_bulk - Creates every Wishlist in the posted list, reporting per item
+PUT  /wishlists/{id} - Updates a Wishlist in the database fom the posted database,
+                        send the ETag in If-Match to update without reading it first
+PATCH /wishlists/{id} - Applies the posted JSON Patch operations to a Wishlist
+DELETE /wishlists/{wishlist_id} - Removes a Wishlist from the database that matches the id,
+                        send the ETag in If-Match to delete without reading it first
 DELETE /wishlists/{wishlist_user}/delete_all - Removes all wishlists of a user
+POST /wishlists/{wishlist_id}/entries - Adds the posted entry to a Wishlist
+DELETE /wishlists/{wishlist_id}/entries/{entry_id} - Removes an entry from a Wishlist
 """
 import os
 import sys
+import math
 import logging
-from flask import jsonify, request, json, url_for, make_response, abort, Response
+import threading
+from flask import jsonify, request, json, url_for, make_response, abort, Response, \
+    stream_with_context, g
 from flask_api import status    # HTTP Status Codes
-from flask_restplus import Api, Resource, fields
+from flask_restplus import Api, Resource, fields, marshal
 from werkzeug.exceptions import NotFound
-from app.models import Wishlist, Wishlist_entry, DataValidationError, DatabaseConnectionError
+from werkzeug.http import quote_etag
+from app.models import Wishlist, Wishlist_entry, DataValidationError, DatabaseConnectionError, \
+    DataConflictError, CircuitOpenError, StorageOverloadError, storage_retry, storage_breaker, \
+    storage_limiter, service_metrics, storage_round_trips
 from . import app
 from requests import HTTPError, ConnectionError
-from retry import retry
+
+# Upper bound on the page size a client may request with ?limit=
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '200'))
+# Page size of a listing that does not ask for one with ?limit=
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '100'))
+# Number of wishlists fetched from the database per batch while streaming
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '100'))
+
+# Report the storage calls of each request in a Server-Timing header
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'True') == 'True'
+
+NDJSON = 'application/x-ndjson'
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Set once warm_up has opened the database, /readiness reports it
+READY = threading.Event()
+WARM_UP_LOCK = threading.Lock()
+
+# Upper bound on the number of wishlists in one POST /wishlists/_bulk
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', '1000'))
+# Status reported for a wishlist of a bulk create by the error it failed with
+BULK_ERROR_STATUS = {
+    'conflict': status.HTTP_409_CONFLICT,
+    'forbidden': status.HTTP_403_FORBIDDEN,
+    'unavailable': status.HTTP_503_SERVICE_UNAVAILABLE
+}
 
 ######################################################################
 # GET INDEX
@@ -67,6 +113,15 @@ wishlist_model = api.model('Wishlist', {
 })
 
 
+patch_operation = api.model('PatchOperation', {
+    'op': fields.String(required=True, enum=['add', 'remove', 'replace', 'move', 'copy', 'test'],
+                        description='The JSON Patch operation'),
+    'path': fields.String(required=True, description='JSON Pointer to the changed value'),
+    'from': fields.String(description='JSON Pointer to the source of a move or copy'),
+    'value': fields.Raw(description='The value to add, replace or test')
+})
+
+
 ######################################################################
 # Special Error Handlers
 ######################################################################
@@ -79,16 +134,30 @@ def request_validation_error(error):
 
 
 
+@api.errorhandler(DataConflictError)
+def data_conflict_error(error):
+    """ Handles writes based on a revision that is no longer current """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return {'status': 409, 'error': 'Conflict', 'message': message}, 409
+
+
+@api.errorhandler(CircuitOpenError)
+@api.errorhandler(StorageOverloadError)
 @api.errorhandler(DatabaseConnectionError)  
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
     message = error.message or str(error)
     app.logger.critical(message)
+    headers = {}
+    # an open circuit breaker or a shed request knows when to try again
+    if getattr(error, 'retry_after', None):
+        headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
     return {
         'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
         'error': 'Service Unavailable',
         'message': message
-    }, status.HTTP_503_SERVICE_UNAVAILABLE
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, headers
 
 
 ######################################################################
@@ -101,6 +170,123 @@ def healthcheck():
     """ Let them know our heart is still beating """
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
+
+@app.route('/readiness')
+def readiness():
+    """ Let the router know if the warm-up has finished, retrying it if it failed """
+    if not READY.is_set():
+        try:
+            warm_up()
+        except Exception as error:  # pylint: disable=broad-except
+            app.logger.warning('Warm-up failed: %s', error)
+            return make_response(jsonify(status=503, message='Warming up'),
+                                 status.HTTP_503_SERVICE_UNAVAILABLE)
+    return make_response(jsonify(status=200, message='Ready'), status.HTTP_200_OK)
+
+
+@app.route('/stats')
+def stats():
+    """ Reports the counters of the Wishlist cache and the storage guards """
+    return make_response(jsonify(cache=Wishlist.cache.stats(), retries=storage_retry.stats(),
+                                 breaker=storage_breaker.stats(),
+                                 limiter=storage_limiter.stats()), status.HTTP_200_OK)
+
+
+@app.route('/metrics')
+def metrics():
+    """ Reports request and storage metrics for Prometheus to scrape """
+    return make_response(service_metrics.render(), status.HTTP_200_OK,
+                         {'Content-Type': PROMETHEUS})
+
+
+######################################################################
+# REQUEST METRICS
+######################################################################
+service_metrics.family('wishlist_http_request_duration_seconds', 'histogram',
+                       'Seconds taken to answer a request', ('method', 'route', 'status'))
+service_metrics.family('wishlist_http_requests_in_flight', 'gauge', 'Requests being answered')
+
+
+@app.before_request
+def start_request_timer():
+    """ Counts the request in flight and notes when it started """
+    g.request_start = service_metrics.timer()
+    service_metrics.inc('wishlist_http_requests_in_flight')
+
+
+@app.after_request
+def record_request_latency(response):
+    """ Records how long the request took by route and status """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    service_metrics.observe('wishlist_http_request_duration_seconds',
+                            (request.method, route, str(response.status_code)),
+                            service_metrics.timer() - g.request_start)
+    return response
+
+
+@app.teardown_request
+def end_request_timer(exception=None):
+    """ Takes the finished request out of flight """
+    if g.pop('request_start', None) is not None:
+        service_metrics.dec('wishlist_http_requests_in_flight')
+
+
+@app.before_request
+def start_round_trips():
+    """ Starts counting the storage calls of the request """
+    storage_round_trips.start_request()
+
+
+@app.after_request
+def report_round_trips(response):
+    """ Reports the storage calls of the request in Server-Timing
+
+    A streamed response sends its headers before the body has read the
+    database, so it has no Server-Timing header.
+    """
+    if SERVER_TIMING and not response.is_streamed:
+        response.headers.add('Server-Timing', server_timing(storage_round_trips.calls(),
+                                                            storage_round_trips.http_calls() or None))
+    return response
+
+
+@app.teardown_request
+def end_round_trips(exception=None):
+    """ Logs and drops the storage calls of the finished request """
+    if app.logger.isEnabledFor(logging.DEBUG):
+        calls = storage_round_trips.calls()
+        http_calls = storage_round_trips.http_calls()
+        app.logger.debug('%s %s made %d storage calls in %d HTTP requests taking %.1f ms: %s',
+                         request.method, request.path,
+                         sum(count for count, _ in calls.values()),
+                         sum(count for count, _ in http_calls.values()),
+                         sum(seconds for _, seconds in calls.values()) * 1000,
+                         ', '.join('{} x{}'.format(operation, count)
+                                   for operation, (count, _) in calls.items()))
+    storage_round_trips.end_request()
+
+
+######################################################################
+# WARM-UP AND RETRY BUDGET
+######################################################################
+@app.before_request
+def ensure_warm_up():
+    """ Warms up on the first request of a worker that was not warmed up at start """
+    if not READY.is_set() and request.endpoint not in ('healthcheck', 'readiness', 'metrics'):
+        warm_up()
+
+
+@app.before_request
+def start_retry_budget():
+    """ Gives each request its own budget of storage retries and deadline """
+    storage_retry.start_request()
+
+
+@app.teardown_request
+def end_retry_budget(exception=None):
+    """ Drops the retry budget of the finished request """
+    storage_retry.end_request()
+
 ######################################################################
 #  PATH: /wishlists
 ######################################################################
@@ -113,32 +299,51 @@ class WishlistCollection(Resource):
     @ns.doc('list_wishlists')
     @ns.param('wishlist_user', 'List Wishlists of a user')
     @ns.param('wishlist_name', 'Show wishlist with this name')
-    @ns.marshal_with(wishlist_model)
+    @ns.param('limit', 'Return at most this many wishlists per page, 100 by default')
+    @ns.param('cursor', 'The cursor of the page to return, taken from X-Next-Cursor')
+    @ns.param('stream', 'Stream the wishlists as they are read from the database')
+    @ns.response(400, 'The paging parameters were not valid')
+    @ns.response(200, 'Success', [wishlist_model])
     # @retry(HTTPError, delay=1, backoff=5, tries=10)
     def get(self):
         """ Retrieves all the wishlists """
         app.logger.info('Request to list wishlists')
-        wishlists = []
         wishlist_user = request.args.get('wishlist_user')
         wishlist_name = request.args.get('wishlist_name')
         app.logger.info('Request to list wishlists of user %s with name: %s', wishlist_user, wishlist_name)
 
-        if wishlist_user:
-            a = Wishlist.find_by_user(wishlist_user)
-            ay = [w.serialize() for w in a]
-
-            if wishlist_name:
-                b = Wishlist.find_by_name(wishlist_name)
-                bee = [w.serialize() for w in b]
-
-                wishlists = [x for x in ay if x in bee]
-            else:
-                wishlists = ay
+        if wants_stream():
+            return self.get_stream(wishlist_user, wishlist_name)
+        # a listing is always paged so no request reads the whole database,
+        # clients follow X-Next-Cursor or stream to see every wishlist
+        return self.get_page(wishlist_user, wishlist_name)
+
+    def get_stream(self, wishlist_user, wishlist_name):
+        """ Streams the wishlists to the client one at a time """
+        selector = wishlist_selector(wishlist_user, wishlist_name)
+        wishlists = Wishlist.iterate_projected(STREAM_BATCH_SIZE, **selector)
+        if wants_ndjson():
+            body, mimetype = generate_ndjson(wishlists), NDJSON
         else:
-            wishlists = [w.serialize() for w in Wishlist.all()]
-
-        app.logger.info('[%s] Wishlists returned', len(wishlists))
-        return wishlists, status.HTTP_200_OK
+            body, mimetype = generate_json_array(wishlists), 'application/json'
+        app.logger.info('Streaming wishlists as %s', mimetype)
+        return Response(stream_with_context(body), status.HTTP_200_OK, mimetype=mimetype)
+
+    def get_page(self, wishlist_user, wishlist_name):
+        """ Retrieves a single page of wishlists starting at the cursor """
+        limit = get_page_limit()
+        cursor = request.args.get('cursor')
+        selector = wishlist_selector(wishlist_user, wishlist_name)
+        wishlists, next_cursor = Wishlist.page_projected(limit, cursor, **selector)
+        app.logger.info('[%s] Wishlists returned in page', len(wishlists))
+        headers = {}
+        if next_cursor:
+            params = dict(selector_args(wishlist_user, wishlist_name),
+                          limit=limit, cursor=next_cursor)
+            next_url = api.url_for(WishlistCollection, _external=True, **params)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            headers['X-Next-Cursor'] = next_cursor
+        return wishlists, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW WISHLIST
@@ -166,6 +371,57 @@ class WishlistCollection(Resource):
             WishlistResource, wishlist_id=wishlist.id, _external=True)
         return wishlist.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /wishlists/_bulk
+######################################################################
+@ns.route('/_bulk')
+class WishlistBulkResource(Resource):
+    """ Handles creating many Wishlists in one request """
+
+    @ns.doc('create_wishlists_in_bulk')
+    @ns.expect([wishlist_model])
+    @ns.response(400, 'The posted data was not a list of wishlists')
+    @ns.response(201, 'All wishlists created successfully')
+    @ns.response(207, 'Some wishlists could not be created, each reports its own status')
+    def post(self):
+        """
+        Creates many Wishlists
+
+        This endpoint will create every Wishlist in the posted list and
+        report the id or the error of each one in the same order
+        """
+        app.logger.info('Request to Create wishlists in bulk')
+        check_content_type('application/json')
+        payload = api.payload
+        if not isinstance(payload, list):
+            raise DataValidationError('Invalid request: body must be a list of wishlists')
+        if len(payload) > MAX_BULK_SIZE:
+            raise DataValidationError(
+                'Invalid request: at most {} wishlists per request'.format(MAX_BULK_SIZE))
+
+        results = [None] * len(payload)
+        valid = []
+        for index, data in enumerate(payload):
+            try:
+                valid.append((index, Wishlist().deserialize(data)))
+            except DataValidationError as error:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST,
+                                  'error': error.message or str(error)}
+
+        errors = Wishlist.bulk_create([wishlist for _, wishlist in valid])
+        for (index, wishlist), error in zip(valid, errors):
+            if error:
+                results[index] = {'status': BULK_ERROR_STATUS.get(
+                    error[0], status.HTTP_500_INTERNAL_SERVER_ERROR), 'error': error[1]}
+            else:
+                results[index] = {'status': status.HTTP_201_CREATED, 'id': wishlist.id}
+
+        created = len([r for r in results if 'id' in r])
+        app.logger.info('[%s] of [%s] wishlists created in bulk', created, len(results))
+        if created == len(results):
+            return results, status.HTTP_201_CREATED
+        return results, status.HTTP_207_MULTI_STATUS
+
 ######################################################################
 #  PATH: /wishlists/{id}
 ######################################################################
@@ -178,8 +434,9 @@ class WishlistResource(Resource):
     WishlistResource class
 
     Allows the manipulation of a single wishlists
-    GET /wishlist/{id} - Returns a wishlist with the id
+    GET /wishlist/{id} - Returns a wishlist with the id, its revision is the ETag
     PUT /wishlist/{id} - Update a wishlist with the id
+    PATCH /wishlist/{id} - Apply JSON Patch operations to a wishlist with the id
     DELETE /wishlist/{id} - Return a wishlist with the id
     """
 
@@ -188,7 +445,8 @@ class WishlistResource(Resource):
     # ------------------------------------------------------------------
     @ns.doc('get_wishlist')
     @ns.response(404, 'Wishlist not found')
-    @ns.marshal_with(wishlist_model)
+    @ns.response(304, 'Wishlist not modified since the If-None-Match revision')
+    @ns.response(200, 'Success', wishlist_model)
     # @retry(HTTPError, delay=1, backoff=5, tries=10)
     def get(self, wishlist_id):
         """
@@ -198,10 +456,18 @@ class WishlistResource(Resource):
         """
         app.logger.info(
             "Request to retrieve a wishlist with id [%s]", wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
+        rev = None
+        if request.if_none_match:
+            # a HEAD request is enough to tell if the client copy is current
+            rev = Wishlist.revision(wishlist_id)
+            if rev and request.if_none_match.contains(rev):
+                app.logger.info('Wishlist with id [%s] not modified', wishlist_id)
+                return '', status.HTTP_304_NOT_MODIFIED, {'ETag': quote_etag(rev)}
+        wishlist = Wishlist.find(wishlist_id, rev)
         if not wishlist:
             api.abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found" .format(wishlist_id))
-        return wishlist.serialize(), status.HTTP_200_OK
+        return marshal(wishlist.serialize(), wishlist_model), status.HTTP_200_OK, \
+            {'ETag': quote_etag(wishlist.rev)}
 
     # ------------------------------------------------------------------
     # DELETE A WISHLIST
@@ -209,6 +475,7 @@ class WishlistResource(Resource):
 
     @ns.doc('delete_wishlist')
     @ns.response(204, 'Wishlist deleted')
+    @ns.response(412, 'Wishlist revision does not match If-Match')
     # @retry(HTTPError, delay=1, backoff=5, tries=10)
     def delete(self, wishlist_id):
         """
@@ -218,9 +485,17 @@ class WishlistResource(Resource):
         """
         app.logger.info(
             'Request to Delete a wishlist with id [%s]', wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
-        if wishlist:
-            wishlist.delete_wishlist()
+        if_match = get_if_match()
+        try:
+            deleted = Wishlist.delete_by_id(wishlist_id, if_match)
+        except DataConflictError:
+            if if_match:
+                api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                          "Wishlist with id {} is not at revision {}".format(wishlist_id, if_match))
+            # changed between reading its revision and deleting it, a second
+            # conflict is answered with 409
+            deleted = Wishlist.delete_by_id(wishlist_id)
+        app.logger.info('Wishlist with id [%s] deleted: %s', wishlist_id, deleted)
         return '', status.HTTP_204_NO_CONTENT
 
         # ------------------------------------------------------------------
@@ -231,6 +506,8 @@ class WishlistResource(Resource):
     @ns.response(400, 'The posted data was not valid')
     @ns.response(200, 'Wishlist updated successfully')
     @ns.response(404, 'Whislist not found')
+    @ns.response(409, 'Wishlist was changed by another request')
+    @ns.response(412, 'Wishlist revision does not match If-Match')
     # @retry(HTTPError, delay=1, backoff=5, tries=10)
     def put(self, wishlist_id):
         """
@@ -240,19 +517,122 @@ class WishlistResource(Resource):
         """
         app.logger.info(
             'Request to Update a wishlist with id [%s]', wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
+        if_match = get_if_match()
+        if if_match:
+            # the client knows the revision, write without reading first
+            wishlist = Wishlist()
+            wishlist.id = wishlist_id
+            wishlist.rev = if_match
+        else:
+            wishlist = Wishlist.find(wishlist_id, cached=False)
+        saved = False
         if wishlist:
             app.logger.info('Payload to update = %s', api.payload)
             wishlist.deserialize(api.payload)
             if wishlist.name == None or wishlist.name == "":
                 app.logger.info('Payload to update missing name')
                 api.abort(status.HTTP_400_BAD_REQUEST, "Missing wishlist name")
-            wishlist.save()
-        else:
+            try:
+                saved = wishlist.save()
+            except DataConflictError:
+                if if_match:
+                    api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                              "Wishlist with id {} is not at revision {}".format(wishlist_id, if_match))
+                raise
+        if not saved:
             app.logger.info('Wishlist with id [%s] not found', wishlist_id)
             api.abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} not found".format(wishlist_id))
         app.logger.info('Wishlist with  id [%s] updated', wishlist.id)
-        return '', status.HTTP_200_OK
+        return '', status.HTTP_200_OK, {'ETag': quote_etag(wishlist.rev)}
+
+
+    # ------------------------------------------------------------------
+    # PATCH A WISHLIST
+    # ------------------------------------------------------------------
+    @ns.doc('patch_wishlist')
+    @ns.expect([patch_operation])
+    @ns.response(400, 'The posted patch was not valid')
+    @ns.response(404, 'Wishlist not found')
+    @ns.response(409, 'Wishlist was changed by another request')
+    @ns.response(412, 'Wishlist revision does not match If-Match')
+    @ns.response(200, 'Wishlist patched successfully', wishlist_model)
+    def patch(self, wishlist_id):
+        """
+        Patch a Wishlist
+
+        This endpoint will apply JSON Patch operations to a Wishlist based on it's id
+        """
+        app.logger.info('Request to Patch a wishlist with id [%s]', wishlist_id)
+        check_content_type('application/json-patch+json')
+        if_match = get_if_match()
+        app.logger.info('Patch = %s', api.payload)
+        try:
+            wishlist = Wishlist.patch(wishlist_id, api.payload, if_match)
+        except DataConflictError:
+            if if_match:
+                api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                          "Wishlist with id {} is not at revision {}".format(wishlist_id, if_match))
+            raise
+        if not wishlist:
+            api.abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} not found".format(wishlist_id))
+        app.logger.info('Wishlist with id [%s] patched', wishlist_id)
+        return marshal(wishlist.serialize(), wishlist_model), status.HTTP_200_OK, \
+            {'ETag': quote_etag(wishlist.rev)}
+
+
+######################################################################
+#  PATH: /wishlists/{id}/entries
+######################################################################
+@ns.route('/<wishlist_id>/entries')
+@ns.param('wishlist_id', 'The Wishlist identifier')
+class WishlistEntryCollection(Resource):
+    """ Handles adding single entries to a Wishlist """
+
+    @ns.doc('create_wishlist_entry')
+    @ns.expect(list_item)
+    @ns.response(400, 'The posted data was not valid')
+    @ns.response(404, 'Wishlist not found')
+    @ns.response(201, 'Entry added successfully')
+    @ns.marshal_with(list_item, code=201)
+    def post(self, wishlist_id):
+        """
+        Adds an entry to a Wishlist
+
+        This endpoint will add the posted entry to a Wishlist without
+        rewriting the rest of it, the entry id is assigned by the service
+        """
+        app.logger.info('Request to add an entry to wishlist [%s]', wishlist_id)
+        check_content_type('application/json')
+        entry = Wishlist_entry().deserialize(api.payload)
+        if not Wishlist.add_entry(wishlist_id, entry):
+            api.abort(status.HTTP_404_NOT_FOUND, "Wishlist with id {} not found".format(wishlist_id))
+        app.logger.info('Entry [%s] added to wishlist [%s]', entry.id, wishlist_id)
+        location_url = api.url_for(WishlistEntryResource, wishlist_id=wishlist_id,
+                                   entry_id=entry.id, _external=True)
+        return entry.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+
+
+######################################################################
+#  PATH: /wishlists/{id}/entries/{entry_id}
+######################################################################
+@ns.route('/<wishlist_id>/entries/<int:entry_id>')
+@ns.param('wishlist_id', 'The Wishlist identifier')
+@ns.param('entry_id', 'The entry identifier')
+class WishlistEntryResource(Resource):
+    """ Handles removing single entries from a Wishlist """
+
+    @ns.doc('delete_wishlist_entry')
+    @ns.response(204, 'Entry deleted')
+    def delete(self, wishlist_id, entry_id):
+        """
+        Delete an entry of a Wishlist
+
+        This endpoint will remove an entry without rewriting the rest of the Wishlist
+        """
+        app.logger.info('Request to delete entry [%s] of wishlist [%s]', entry_id, wishlist_id)
+        deleted = Wishlist.delete_entry(wishlist_id, entry_id)
+        app.logger.info('Entry [%s] of wishlist [%s] deleted: %s', entry_id, wishlist_id, deleted)
+        return '', status.HTTP_204_NO_CONTENT
 
 
 ######################################################################
@@ -268,9 +648,8 @@ class DeleteAllResource(Resource):
     def delete(self, wishlist_user):
         """ Removes all wishlists of a user"""
         app.logger.info('Request to delete all wishlists of a user')
-        wishlists = Wishlist.find_by_user(wishlist_user)
-        for wishlist in wishlists:
-            wishlist.delete_wishlist()
+        deleted = Wishlist.remove_by_user(wishlist_user)
+        app.logger.info('[%s] Wishlists of user %s deleted', deleted, wishlist_user)
         return '', status.HTTP_204_NO_CONTENT
 
 
@@ -299,6 +678,113 @@ def check_content_type(content_type): # pragma: no cover
           'Content-Type must be {}'.format(content_type))
 
 
+def get_page_limit():
+    """ Reads and validates the ?limit= paging parameter """
+    if 'limit' not in request.args:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(request.args.get('limit'))
+    except (TypeError, ValueError):
+        raise DataValidationError('limit must be an integer')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError(
+            'limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return limit
+
+
+def get_if_match():
+    """ Returns the single revision named by If-Match, None if there is none """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    revisions = request.if_match.as_set()
+    if len(revisions) != 1:
+        raise DataValidationError('If-Match must name exactly one revision')
+    return revisions.pop()
+
+
+def wants_stream():
+    """ Checks if the client asked for a streamed collection """
+    if request.args.get('stream', '').lower() == 'true':
+        return True
+    return wants_ndjson()
+
+
+def wants_ndjson():
+    """ Checks if the client prefers newline delimited JSON """
+    return request.accept_mimetypes.best == NDJSON
+
+
+def generate_ndjson(wishlists):
+    """ Yields one JSON encoded wishlist per line """
+    for wishlist in wishlists:
+        yield json.dumps(wishlist) + '\n'
+
+
+def generate_json_array(wishlists):
+    """ Yields a JSON array of wishlists one element at a time """
+    separator = '['
+    for wishlist in wishlists:
+        yield separator + json.dumps(wishlist)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def wishlist_selector(wishlist_user, wishlist_name):
+    """ Builds the model selector of a collection request """
+    selector = {}
+    if wishlist_user:
+        selector['user'] = wishlist_user
+        if wishlist_name:
+            selector['name'] = wishlist_name
+    return selector
+
+
+def selector_args(wishlist_user, wishlist_name):
+    """ Rebuilds the filter query parameters of a collection request """
+    args = {}
+    if wishlist_user:
+        args['wishlist_user'] = wishlist_user
+        if wishlist_name:
+            args['wishlist_name'] = wishlist_name
+    return args
+
+
+def warm_up(dbname='wishlists'):
+    """
+    Opens the storage engine and its connections before traffic arrives
+
+    Runs once per process, later calls return at once
+    """
+    with WARM_UP_LOCK:
+        if READY.is_set():
+            return
+        app.logger.info('Warming up the %s database', dbname)
+        Wishlist.init_db(dbname)
+        Wishlist.warm_up()
+        READY.set()
+        app.logger.info('Warm-up finished')
+
+
+def server_timing(calls, http_calls=None):
+    """ Formats the storage calls of a request as a Server-Timing header
+
+    The db metric holds the number and total time of all calls and is
+    followed by one db-<operation> metric per operation called. When the
+    storage sent HTTP requests the http metric and one http-<method>
+    metric per method follow, counting every request including retries.
+    """
+    totals = []
+    for prefix, ledger in (('db', calls), ('http', http_calls)):
+        if ledger is None:
+            continue
+        totals.append((prefix, sum(count for count, _ in ledger.values()),
+                       sum(seconds for _, seconds in ledger.values())))
+        totals.extend(('{}-{}'.format(prefix, key), count, seconds)
+                      for key, (count, seconds) in ledger.items())
+    return ', '.join('{};desc="{} calls";dur={:.1f}'.format(name, count, seconds * 1000)
+                     for name, count, seconds in totals)
+
+
 def initialize_logging(log_level=logging.INFO): # pragma: no cover
     """ Initialized the default logging to STDOUT """
     if not app.debug:
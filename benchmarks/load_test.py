@@ -0,0 +1,126 @@
+"""
+Serving Mode Load Test
+
+Starts the service under gunicorn with a sync, a gthread and a gevent
+worker and measures the GET /wishlists requests per second each one
+serves to the same number of concurrent clients, while every storage
+call waits STORAGE_LATENCY seconds as a Cloudant round trip would.
+
+    python benchmarks/load_test.py [concurrency] [seconds]
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import httplib
+import threading
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('LOAD_TEST_PORT', '5099'))
+WISHLISTS = 20
+MODES = ('sync', 'gthread', 'gevent')
+
+
+def request(method, path, body=None):
+    """ Sends one request on a new connection, returns the status """
+    connection = httplib.HTTPConnection(HOST, PORT, timeout=60)
+    try:
+        headers = {'Content-Type': 'application/json'} if body else {}
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def start_server(mode):
+    """ Starts gunicorn with one worker of the given class and waits until it is ready """
+    env = dict(os.environ, STORAGE_ENGINE='slow-memory', GUNICORN_WORKER_CLASS=mode)
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         '--config=gunicorn.conf.py', '--workers=1', '--backlog=2048',
+         '--bind={}:{}'.format(HOST, PORT), 'benchmarks.slow_storage:app'],
+        cwd=ROOT, env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            if request('GET', '/readiness') == 200:
+                return server
+        except (socket.error, httplib.HTTPException):
+            pass
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('gunicorn did not become ready with a {} worker'.format(mode))
+
+
+def run_clients(concurrency, seconds):
+    """ Lets concurrency clients send requests for some seconds
+
+    Only requests that finish inside the window count. Returns their
+    latencies, the errors and the length of the window in seconds.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    started = time.time()
+    deadline = started + seconds
+
+    def client():
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                ok = request('GET', '/wishlists') == 200
+            except (socket.error, httplib.HTTPException):
+                ok = False
+            end = time.time()
+            if end > deadline:
+                return
+            with lock:
+                if ok:
+                    latencies.append(end - start)
+                else:
+                    errors[0] += 1
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return sorted(latencies), errors[0], deadline - started
+
+
+def measure(mode, concurrency, seconds):
+    """ Serves the load test with one worker class and returns its results """
+    server = start_server(mode)
+    try:
+        for i in range(WISHLISTS):
+            request('POST', '/wishlists', json.dumps({
+                'name': 'wishlist {}'.format(i), 'user': 'load test',
+                'entries': [{'id': 0, 'name': 'item'}]}))
+        latencies, errors, window = run_clients(concurrency, seconds)
+    finally:
+        server.terminate()
+        server.wait()
+    if not latencies:
+        return 0, 0, 0, errors
+    return (len(latencies) / window,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            errors)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    SECONDS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print 'GET /wishlists, {} clients for {}s, storage latency {}s'.format(
+        CONCURRENCY, SECONDS, os.environ.get('STORAGE_LATENCY', '0.05'))
+    print '  {:<10}{:>10}{:>12}{:>12}{:>8}'.format('worker', 'req/s', 'p50 ms', 'p99 ms', 'errors')
+    for MODE in MODES:
+        print '  {:<10}{:>10.1f}{:>12.1f}{:>12.1f}{:>8}'.format(MODE, *measure(MODE, CONCURRENCY, SECONDS))
@@ -0,0 +1,90 @@
+"""
+Model Memory Benchmark
+
+Measures the memory held by 10,000 wishlist entries with the slot based
+models against the same objects backed by a __dict__, along with the
+time it takes to serialize them.
+
+    python benchmarks/model_memory.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.models import Wishlist, Wishlist_entry
+
+ENTRIES = 10000
+ENTRIES_PER_WISHLIST = 10
+
+
+class DictEntry(object):
+    """ A Wishlist_entry as it was before it had __slots__ """
+    def __init__(self, entry_id=0, item_name=''):
+        self.id = entry_id
+        self.name = item_name
+
+    def serialize(self):
+        return {"id": self.id, "name": self.name}
+
+
+class DictWishlist(object):
+    """ A Wishlist as it was before it had __slots__ """
+    def __init__(self, wishlist_name=None, wishlist_user=None, wishlist_entries=None):
+        self.id = None
+        self.rev = None
+        self.name = wishlist_name
+        self.user = wishlist_user
+        self.entries = wishlist_entries
+
+    def serialize(self):
+        return {"id": self.id, "name": self.name, "user": self.user,
+                "entries": [entry.serialize() for entry in self.entries]}
+
+
+def build(wishlist_class, entry_class):
+    """ Builds wishlists holding ENTRIES entries in total """
+    return [wishlist_class('wishlist %d' % i, 'user %d' % i,
+                           [entry_class(j, 'item %d' % j) for j in range(ENTRIES_PER_WISHLIST)])
+            for i in range(ENTRIES // ENTRIES_PER_WISHLIST)]
+
+
+def object_size(wishlists):
+    """ Returns the bytes held by the model objects, their lists and __dict__s
+
+    The id, name and user values are shared by both layouts and left out.
+    """
+    total = sys.getsizeof(wishlists)
+    for wishlist in wishlists:
+        total += sys.getsizeof(wishlist) + sys.getsizeof(wishlist.entries)
+        total += sys.getsizeof(getattr(wishlist, '__dict__', None) or ())
+        for entry in wishlist.entries:
+            total += sys.getsizeof(entry)
+            total += sys.getsizeof(getattr(entry, '__dict__', None) or ())
+    return total
+
+
+def serialize_time(wishlists):
+    """ Returns the best time in milliseconds to serialize every wishlist """
+    timer = timeit.Timer(lambda: [wishlist.serialize() for wishlist in wishlists])
+    return min(timer.repeat(repeat=5, number=1)) * 1000
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    dict_models = build(DictWishlist, DictEntry)
+    slot_models = build(Wishlist, Wishlist_entry)
+    dict_bytes = object_size(dict_models)
+    slot_bytes = object_size(slot_models)
+    print 'Memory per {:,} entries'.format(ENTRIES)
+    print '  {:<18}{:>12,} bytes'.format('__dict__ models:', dict_bytes)
+    print '  {:<18}{:>12,} bytes'.format('__slots__ models:', slot_bytes)
+    print '  {:<18}{:>12,} bytes ({:.0%})'.format('saved:', dict_bytes - slot_bytes,
+                                               1 - float(slot_bytes) / dict_bytes)
+    print 'Serialize {:,} entries'.format(ENTRIES)
+    print '  {:<18}{:>12.2f} ms'.format('__dict__ models:', serialize_time(dict_models))
+    print '  {:<18}{:>12.2f} ms'.format('__slots__ models:', serialize_time(slot_models))
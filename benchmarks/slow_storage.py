@@ -0,0 +1,33 @@
+"""
+Wishlist Service with simulated storage latency
+
+Serves the app on an in-memory engine whose every call first waits
+STORAGE_LATENCY seconds, as a round trip to Cloudant would. Used by
+load_test.py and selected with STORAGE_ENGINE=slow-memory.
+"""
+
+import os
+import time
+import functools
+from app import app, models
+
+STORAGE_LATENCY = float(os.environ.get('STORAGE_LATENCY', '0.05'))
+
+
+def delayed(method):
+    """ Makes a storage engine method wait STORAGE_LATENCY seconds first """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        time.sleep(STORAGE_LATENCY)
+        return method(*args, **kwargs)
+    return wrapper
+
+
+class SlowMemoryEngine(models.MemoryEngine):
+    """ An in-memory engine as slow as a database across the network """
+    databases = {}
+
+for name in ('create', 'get', 'revision', 'update', 'delete', 'query', 'bulk_delete'):
+    setattr(SlowMemoryEngine, name, delayed(getattr(models.MemoryEngine, name)))
+
+models.STORAGE_ENGINES['slow-memory'] = SlowMemoryEngine
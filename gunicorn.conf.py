@@ -0,0 +1,151 @@
+"""
+Gunicorn settings for the Wishlist Service
+
+Used by the Procfile with --config=gunicorn.conf.py. Set
+GUNICORN_WORKER_CLASS=gevent to serve hundreds of requests per worker
+while they wait on the database.
+
+Workers are sized from the CPUs and memory the container may use, the
+app is imported once in the master and shared copy-on-write, and a
+worker whose private memory grows past its share of the container is
+replaced.
+"""
+import os
+import multiprocessing
+
+CGROUP = '/sys/fs/cgroup'
+MEGABYTE = 1024 * 1024
+
+
+def read_cgroup(*paths):
+    """ Returns the first line of the first cgroup file found, or None """
+    for path in paths:
+        try:
+            with open(os.path.join(CGROUP, path)) as cgroup_file:
+                return cgroup_file.readline().strip()
+        except IOError:
+            continue
+    return None
+
+
+def cpu_limit():
+    """ Returns the CPUs this container may use, at least one """
+    cpus = multiprocessing.cpu_count()
+    quota = read_cgroup('cpu.max')  # cgroup v2: "<quota> <period>"
+    if quota:
+        quota, period = quota.split()
+    else:
+        quota = read_cgroup('cpu/cpu.cfs_quota_us', 'cpu,cpuacct/cpu.cfs_quota_us')
+        period = read_cgroup('cpu/cpu.cfs_period_us', 'cpu,cpuacct/cpu.cfs_period_us')
+    if quota and period and quota not in ('max', '-1'):
+        cpus = min(cpus, -(-int(quota) // int(period)))
+    return max(1, cpus)
+
+
+def memory_limit():
+    """ Returns the bytes of memory this container may use """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    limit = read_cgroup('memory.max', 'memory/memory.limit_in_bytes')
+    if limit and limit.isdigit():
+        memory = min(memory, int(limit))
+    return memory
+
+
+def resident_memory():
+    """ Returns the resident memory of this process in bytes """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.readline().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def worker_memory():
+    """ Returns the private memory of this process in bytes
+
+    Pages a worker still shares copy-on-write with the preloaded master
+    are not counted, they are paid for once by the master.
+    """
+    for path in ('/proc/self/smaps_rollup', '/proc/self/smaps'):
+        try:
+            with open(path) as smaps:
+                return sum(int(line.split()[1]) for line in smaps
+                           if line.startswith(('Private_Clean:', 'Private_Dirty:'))) * 1024
+        except IOError:
+            continue
+    return resident_memory()
+
+
+# Threaded workers share one Cloudant connection pool, see CLOUDANT_POOL_SIZE
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Requests a gevent worker keeps open at once
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+# Private memory a worker may grow to before it is replaced, at most its
+# share of the container. when_ready lowers it further once the size of
+# the preloaded master is known.
+worker_memory_limit = int(os.environ.get('GUNICORN_WORKER_MEMORY', '32')) * MEGABYTE
+
+# A sync worker serves one request at a time, so run the usual two per
+# CPU plus one. Threaded and gevent workers wait on the database in
+# parallel already and only need one process per CPU. Never run more
+# workers than fit in the container next to the master, so a 64M
+# instance runs one worker whatever its CPUs.
+if worker_class == 'sync':
+    workers = 2 * cpu_limit() + 1
+else:
+    workers = cpu_limit()
+workers = max(1, min(workers, memory_limit() // worker_memory_limit - 1))
+workers = int(os.environ.get('GUNICORN_WORKERS', workers))
+worker_memory_limit = min(worker_memory_limit, memory_limit() // (workers + 1))
+# Each thread holds at most one pooled Cloudant connection, more threads
+# than the pool only queue for it. Gunicorn turns sync workers with more
+# than one thread into gthread workers, so only gthread gets threads.
+if worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS', os.environ.get('CLOUDANT_POOL_SIZE', '16')))
+
+# Import the app and build its Swagger spec once, before forking
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'True') == 'True'
+
+if worker_class == 'gevent':
+    # patch before the app is imported so its locks and thread locals are
+    # greenlet aware, and let every open request queue for the database
+    from gevent import monkey
+    monkey.patch_all()
+    os.environ.setdefault('LIMITER_MAX_QUEUE', str(worker_connections))
+
+
+def when_ready(server):
+    """ Builds the Swagger spec in the master so every worker shares it
+
+    Then splits the memory the master leaves over between the workers,
+    which are forked after this hook and inherit the budget.
+    """
+    global worker_memory_limit  # pylint: disable=global-statement
+    if server.cfg.preload_app:
+        from app import app, service
+        with app.test_request_context():
+            service.api.__schema__  # pylint: disable=pointless-statement
+    spare = memory_limit() - resident_memory()
+    worker_memory_limit = max(MEGABYTE, min(worker_memory_limit, spare // server.num_workers))
+    server.log.info('Serving with %d %s workers of up to %d MB private memory',
+                    server.num_workers, server.cfg.worker_class_str,
+                    worker_memory_limit // MEGABYTE)
+
+
+def post_worker_init(worker):
+    """ Warms up each worker before it accepts requests """
+    from app import service
+    try:
+        service.warm_up()
+    except Exception as error:  # pylint: disable=broad-except
+        worker.log.warning('Warm-up failed, /readiness will retry it: %s', error)
+
+
+def post_request(worker, req, environ, resp):  # pylint: disable=unused-argument
+    """ Replaces a worker after this request once it holds too much memory """
+    if worker.alive and worker_memory() > worker_memory_limit:
+        worker.log.info('Worker holds more than %d MB of private memory, replacing it',
+                        worker_memory_limit // MEGABYTE)
+        worker.alive = False
@@ -19,4 +19,8 @@ if __name__ == "__main__":
     print " W I S H L I S T   S E R V I C E   R U N N I N G"
     print "****************************************"
     service.initialize_logging()
+    try:
+        service.warm_up()
+    except Exception as error:
+        print 'Warm-up failed, /readiness will retry it: {}'.format(error)
     app.run(host=HOST, port=int(PORT), debug=DEBUG)
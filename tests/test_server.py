@@ -6,13 +6,15 @@ Test cases can be run with:
   coverage report -m
 """
 import os
+import re
 import logging
 import unittest
 import json
 from flask_api import status    # HTTP Status Codes
 import app.service as service
-from app.models import Wishlist
-from time import sleep  # use for rate limiting Cloudant Lite :(
+from mock import patch
+from requests import ConnectionError
+from app.models import Wishlist, CircuitOpenError, DataConflictError
 
 ######################################################################
 #  T E S T   C A S E S
@@ -27,22 +29,18 @@ class TestWishlistServer(unittest.TestCase):
         self.app = service.app.test_client()
         # TestWishlistServer.throttle_api()
         Wishlist.init_db()
-        sleep(0.25)
         # TestWishlistServer.throttle_api()
         Wishlist("Wishlist demo 1", "demo user1", [service.Wishlist_entry(
             0, "test11"), service.Wishlist_entry(1, "test12")]).save()
-        sleep(0.25)
         # TestWishlistServer.throttle_api()
         Wishlist("Wishlist demo 2", "demo user2", [service.Wishlist_entry(
             0, "test21"), service.Wishlist_entry(1, "test22")]).save()
-        sleep(0.25)
         # TestWishlistServer.throttle_api()
 
     def tearDown(self):
         """ Runs after each test """
         # TestWishlistServer.throttle_api()
         Wishlist.remove_all()
-        sleep(0.5)
 
 
     # @staticmethod
@@ -65,6 +63,75 @@ class TestWishlistServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertIn('Healthy', resp.data)
 
+    def test_readiness(self):
+        """ Readiness reports the warm-up and retries it when it failed """
+        service.READY.clear()
+        resp = self.app.get('/healthcheck')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertFalse(service.READY.is_set())
+        with patch('app.models.Wishlist.warm_up') as warm_up_mock:
+            warm_up_mock.side_effect = ConnectionError()
+            resp = self.app.get('/readiness')
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = self.app.get('/readiness')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('Ready', resp.data)
+
+    def test_first_request_warms_up(self):
+        """ A worker that was not warmed up at start warms up on its first request """
+        service.READY.clear()
+        resp = self.app.get('/wishlists')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(service.READY.is_set())
+
+    def test_stats(self):
+        """ Report the Wishlist cache counters """
+        resp = self.app.get('/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        for counter in ('hits', 'misses', 'evictions', 'size'):
+            self.assertIn(counter, data['cache'])
+
+    def test_metrics(self):
+        """ Report request and storage latency in the Prometheus text format """
+        self.app.get('/wishlists')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('wishlist_http_request_duration_seconds_count'
+                      '{method="GET",route="/wishlists/",status="200"}', resp.data)
+        self.assertIn('operation="iterate",outcome="ok"}', resp.data)
+        self.assertIn('wishlist_http_requests_in_flight 1', resp.data)
+
+    def test_server_timing(self):
+        """ Report the storage calls of each request in Server-Timing """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.delete('/wishlists/{}'.format(wishlist.id),
+                               headers={'If-Match': '"{}"'.format(wishlist.rev)})
+        self.assertEqual(self.storage_calls(resp), {'db': 1, 'db-delete': 1})
+        wishlist = Wishlist.find_by_name('Wishlist demo 2')[0]
+        resp = self.app.delete('/wishlists/{}'.format(wishlist.id))
+        self.assertEqual(self.storage_calls(resp), {'db': 2, 'db-revision': 1, 'db-delete': 1})
+        resp = self.app.get('/healthcheck')
+        self.assertEqual(self.storage_calls(resp), {'db': 0})
+
+    def test_server_timing_http_calls(self):
+        """ Report the HTTP requests sent to the storage after the calls """
+        header = service.server_timing({'read': [1, 0.002]}, {'head': [1, 0.001], 'get': [2, 0.003]})
+        self.assertEqual(header.split(', ')[0], 'db;desc="1 calls";dur=2.0')
+        self.assertIn('http;desc="3 calls";dur=4.0', header)
+        self.assertIn('http-get;desc="2 calls";dur=3.0', header)
+        resp = service.app.response_class(headers={'Server-Timing': header})
+        self.assertEqual(self.storage_calls(resp), {'db': 1, 'db-read': 1})
+
+    def test_circuit_open(self):
+        """ An open circuit breaker answers 503 with Retry-After """
+        with patch('app.models.Wishlist.page_projected') as page_mock:
+            page_mock.side_effect = CircuitOpenError('The database is unavailable', 2.5)
+            resp = self.app.get('/wishlists')
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers['Retry-After'], '3')
+
     def test_delete_wishlist(self):
         """ Delete a wishlist by ID """
         wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
@@ -76,6 +143,40 @@ class TestWishlistServer(unittest.TestCase):
         new_count = self.get_wishlist_count()
         self.assertEqual(new_count, wishlist_count - 1)
 
+    def test_delete_wishlist_changed(self):
+        """ Delete a wishlist that changes between its HEAD and its DELETE """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        delete = Wishlist.engine.delete
+        conflicts = [DataConflictError('changed')]
+        def conflict_once(doc_id, rev):
+            if conflicts:
+                raise conflicts.pop()
+            return delete(doc_id, rev)
+        with patch.object(Wishlist.engine, 'delete', side_effect=conflict_once) as delete_mock:
+            resp = self.app.delete('/wishlists/{}'.format(wishlist.id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(delete_mock.call_count, 2)
+        with patch.object(Wishlist.engine, 'delete', side_effect=DataConflictError('changed')):
+            resp = self.app.delete('/wishlists/{}'.format(
+                Wishlist.find_by_name('Wishlist demo 2')[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_delete_wishlist_if_match(self):
+        """ Delete a wishlist by ID and revision """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.delete('/wishlists/{}'.format(wishlist.id),
+                               headers={'If-Match': '"1-00000000000000000000000000000000"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/wishlists/{}'.format(wishlist.id),
+                               headers={'If-Match': '"{}"'.format(wishlist.rev)})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIsNone(Wishlist.find(wishlist.id))
+
+    def test_delete_wishlist_not_found(self):
+        """ Delete a wishlist that does not exist """
+        resp = self.app.delete('/wishlists/asdf123')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
     def test_get_wishlists_list(self):
         """ Get a list of Wishlists """
         resp = self.app.get('/wishlists')
@@ -83,6 +184,67 @@ class TestWishlistServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
 
+    def test_get_wishlists_list_matches_model(self):
+        """ The listed documents have exactly the shape of wishlist_model """
+        resp = self.app.get('/wishlists', query_string='wishlist_user=demo user1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data, service.marshal(data, service.wishlist_model))
+        wishlist = Wishlist.find(data[0]['id'])
+        self.assertEqual(data[0], wishlist.serialize())
+
+    def test_get_wishlists_page(self):
+        """ Get a page of Wishlists and follow the cursor """
+        resp = self.app.get('/wishlists', query_string='limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        cursor = resp.headers.get('X-Next-Cursor')
+        self.assertIsNotNone(cursor)
+        self.assertIn('rel="next"', resp.headers.get('Link'))
+        resp = self.app.get('/wishlists', query_string={'limit': 5, 'cursor': cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        rest = json.loads(resp.data)
+        self.assertEqual(len(rest), 1)
+        self.assertNotEqual(rest[0]['id'], data[0]['id'])
+        self.assertIsNone(resp.headers.get('X-Next-Cursor'))
+
+    def test_get_wishlists_default_page(self):
+        """ A listing without a limit returns the first page and its cursor """
+        with patch.object(service, 'DEFAULT_PAGE_SIZE', 1):
+            resp = self.app.get('/wishlists')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 1)
+        self.assertIsNotNone(resp.headers.get('X-Next-Cursor'))
+        self.assertIn('limit=1', resp.headers.get('Link'))
+
+    def test_get_wishlists_bad_limit(self):
+        """ Get a page of Wishlists with an invalid limit """
+        resp = self.app.get('/wishlists', query_string='limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/wishlists', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_wishlists(self):
+        """ Stream the list of Wishlists as a JSON array """
+        resp = self.app.get('/wishlists', query_string='stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 2)
+        self.assertIn('entries', data[0])
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_stream_wishlists_ndjson(self):
+        """ Stream the Wishlists of a user as newline delimited JSON """
+        resp = self.app.get('/wishlists', query_string='wishlist_user=demo user1',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['user'], 'demo user1')
+
     def test_query_wishlist_by_user(self):
         """ Get a list of Wishlists for a User"""
         resp = self.app.get(
@@ -117,6 +279,33 @@ class TestWishlistServer(unittest.TestCase):
 		self.assertEqual(data['name'], "Wishlist demo 2")
 	"""
 
+    def test_get_wishlist_etag(self):
+        """ Get a Wishlist and revalidate it with its ETag """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id),
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.assertEqual(resp.headers.get('ETag'), etag)
+
+    def test_get_wishlist_etag_changed(self):
+        """ Get a Wishlist whose ETag is out of date """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        etag = resp.headers.get('ETag')
+        wishlist.name = 'Wishlist demo 1 renamed'
+        wishlist.save()
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id),
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers.get('ETag'), etag)
+        data = json.loads(resp.data)
+        self.assertEqual(data['name'], 'Wishlist demo 1 renamed')
+
     def test_get_wishlist_not_found(self):
         "" "Get a wishlist thats not found """
         resp = self.app.get('/wishlists/12')
@@ -170,6 +359,60 @@ class TestWishlistServer(unittest.TestCase):
 		self.assertEqual(new_json['entries'][0]['name'], 'test31')
 	"""
 
+    def test_create_wishlists_in_bulk(self):
+        """ Create Wishlists in bulk """
+        wishlist_count = self.get_wishlist_count()
+        new_wishlists = [
+            {'name': 'Wishlist demo 3', 'user': 'demo user3', 'entries': []},
+            {'name': 'Wishlist demo 4', 'user': 'demo user3',
+             'entries': [{'id': 0, 'name': 'test41'}]}]
+        resp = self.app.post('/wishlists/_bulk', data=json.dumps(new_wishlists),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = json.loads(resp.data)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(result['status'], status.HTTP_201_CREATED)
+            resp = self.app.get('/wishlists/' + result['id'])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_wishlist_count(), wishlist_count + 2)
+
+    def test_create_wishlists_in_bulk_partial(self):
+        """ Create Wishlists in bulk with one invalid payload """
+        new_wishlists = [
+            {'user': 'demo user3', 'entries': []},
+            {'name': 'Wishlist demo 4', 'user': 'demo user3', 'entries': []}]
+        resp = self.app.post('/wishlists/_bulk', data=json.dumps(new_wishlists),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = json.loads(resp.data)
+        self.assertEqual(results[0]['status'], status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', results[0])
+        self.assertEqual(results[1]['status'], status.HTTP_201_CREATED)
+        self.assertIn('id', results[1])
+
+    def test_create_wishlists_in_bulk_errors(self):
+        """ Each wishlist of a bulk create reports the status of its own error """
+        new_wishlists = [{'name': 'Wishlist {}'.format(i), 'user': 'demo user3', 'entries': []}
+                         for i in range(3)]
+        with patch('app.models.Wishlist.bulk_create') as bulk_mock:
+            bulk_mock.return_value = [None, ('conflict', 'Document update conflict.'),
+                                      ('unavailable', 'The database is unavailable')]
+            resp = self.app.post('/wishlists/_bulk', data=json.dumps(new_wishlists),
+                                 content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = json.loads(resp.data)
+        self.assertEqual([result['status'] for result in results],
+                         [status.HTTP_201_CREATED, status.HTTP_409_CONFLICT,
+                          status.HTTP_503_SERVICE_UNAVAILABLE])
+
+    def test_create_wishlists_in_bulk_not_a_list(self):
+        """ Create Wishlists in bulk with a single object """
+        new_wishlist = {'name': 'Wishlist demo 3', 'user': 'demo user3', 'entries': []}
+        resp = self.app.post('/wishlists/_bulk', data=json.dumps(new_wishlist),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_create_wishlist_with_no_name(self):
         """ Create a Wishlist with the name missing """
         new_wishlist = {'user': 'demo user1', 'entries': [
@@ -260,6 +503,104 @@ class TestWishlistServer(unittest.TestCase):
                             data=data, content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_add_wishlist_entry(self):
+        """ Add an entry to a Wishlist """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.post('/wishlists/{}/entries'.format(wishlist.id),
+                             data=json.dumps({'name': 'test13'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIsNotNone(resp.headers.get('Location'))
+        entry = json.loads(resp.data)
+        self.assertEqual(entry, {'id': 2, 'name': 'test13'})
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['entries']), 3)
+
+    def test_add_wishlist_entry_not_found(self):
+        """ Add an entry to a Wishlist that does not exist """
+        resp = self.app.post('/wishlists/asdf123/entries',
+                             data=json.dumps({'name': 'test13'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add_wishlist_entry_with_no_name(self):
+        """ Add an entry with the name missing """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.post('/wishlists/{}/entries'.format(wishlist.id),
+                             data=json.dumps({'id': 5}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_wishlist_entry(self):
+        """ Delete an entry of a Wishlist """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.delete('/wishlists/{}/entries/0'.format(wishlist.id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        data = json.loads(resp.data)
+        self.assertEqual(data['entries'], [{'id': 1, 'name': 'test12'}])
+
+    def test_update_wishlist_if_match(self):
+        """ Update a Wishlist with the revision from its ETag """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        etag = resp.headers.get('ETag')
+        updated_wishlist = {'name': 'Wishlist demo 1 updated', 'user': 'demo user1',
+                            'entries': [{'id': 0, 'name': 'test11'}]}
+        resp = self.app.put('/wishlists/{}'.format(wishlist.id), data=json.dumps(updated_wishlist),
+                            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers.get('ETag')
+        self.assertNotEqual(new_etag, etag)
+        # the old revision is no longer current
+        resp = self.app.put('/wishlists/{}'.format(wishlist.id), data=json.dumps(updated_wishlist),
+                            content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        self.assertEqual(resp.headers.get('ETag'), new_etag)
+        self.assertEqual(json.loads(resp.data)['name'], 'Wishlist demo 1 updated')
+
+    def test_patch_wishlist(self):
+        """ Rename a Wishlist with a JSON Patch """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        operations = [{'op': 'replace', 'path': '/name', 'value': 'Wishlist demo 1 patched'}]
+        resp = self.app.patch('/wishlists/{}'.format(wishlist.id), data=json.dumps(operations),
+                              content_type='application/json-patch+json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(resp.headers.get('ETag'))
+        data = json.loads(resp.data)
+        self.assertEqual(data['name'], 'Wishlist demo 1 patched')
+        self.assertEqual(len(data['entries']), 2)
+
+    def test_patch_wishlist_bad_patch(self):
+        """ Patch a Wishlist with an invalid JSON Patch """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        operations = [{'op': 'remove', 'path': '/name'}]
+        resp = self.app.patch('/wishlists/{}'.format(wishlist.id), data=json.dumps(operations),
+                              content_type='application/json-patch+json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_wishlist_bad_entry(self):
+        """ Patch in entries without an integer id, nothing is stored """
+        wishlist = Wishlist.find_by_name('Wishlist demo 1')[0]
+        for entry in ({'name': 'bike'}, {'id': 'x', 'name': 5}):
+            operations = [{'op': 'add', 'path': '/entries/-', 'value': entry}]
+            resp = self.app.patch('/wishlists/{}'.format(wishlist.id), data=json.dumps(operations),
+                                  content_type='application/json-patch+json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/wishlists/{}'.format(wishlist.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers.get('ETag'), '"{}"'.format(wishlist.rev))
+        self.assertEqual(len(json.loads(resp.data)['entries']), 2)
+
+    def test_patch_wishlist_not_found(self):
+        """ Patch a Wishlist that can't be found """
+        operations = [{'op': 'replace', 'path': '/name', 'value': 'renamed'}]
+        resp = self.app.patch('/wishlists/0', data=json.dumps(operations),
+                              content_type='application/json-patch+json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_update_wishlist_not_found(self):
         """ Update a wishlist that can't be found """
         new_wish = {"name": "timothy's list", "user": "timothy"}
@@ -282,6 +623,16 @@ class TestWishlistServer(unittest.TestCase):
         self.assertEqual(new_count,0)
 
 
+    @staticmethod
+    def storage_calls(resp):
+        """ Returns the number of storage calls per db Server-Timing metric
+
+        The http metrics are left out, only engines that speak HTTP send them.
+        """
+        return dict((name, int(count)) for name, count in
+                    re.findall(r'(?:^|, )(db[\w-]*);desc="(\d+) calls"',
+                               resp.headers['Server-Timing']))
+
     def get_wishlist_count(self):
         """ save the current number of wishlists """
         resp = self.app.get('/wishlists', content_type='application/json')
@@ -1,11 +1,22 @@
 import unittest
 import os
 import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
 import mock
 from mock import patch
-from requests import HTTPError, ConnectionError
-from app.models import Wishlist, Wishlist_entry, DataValidationError
-from time import sleep  # use for rate limiting Cloudant Lite :(
+from requests import HTTPError, ConnectionError, Response, Request
+from requests.hooks import dispatch_hook
+from cloudant._client_session import CookieSession
+from app import models
+from app.models import Wishlist, Wishlist_entry, DataValidationError, QUERY_INDEXES, \
+	LRUCache, DataConflictError, DatabaseConnectionError, RetryPolicy, CircuitBreaker, \
+	CircuitOpenError, ConcurrencyLimiter, StorageOverloadError, PooledCloudant, KeepAliveAdapter, \
+	is_cooperative, Metrics, MeasuredEngine, RoundTrips
 
 VCAP_SERVICES = {
 	'cloudantNoSQLDB': [
@@ -32,7 +43,6 @@ class TestWishlists(unittest.TestCase):
 		Wishlist.init_db("test")
 		# TestWishlists.throttle_api()
 		Wishlist.remove_all()
-		sleep(0.25)
 
 
 
@@ -40,7 +50,6 @@ class TestWishlists(unittest.TestCase):
 		""" Runs after each test """
 		# if 'VCAP_SERVICES' in os.environ:
 		# 	sleep(0.5)
-		sleep(0.25)
 
 	# @staticmethod
 	# def throttle_api():
@@ -101,6 +110,28 @@ class TestWishlists(unittest.TestCase):
 		self.assertEqual(len(wishlists), 1)
 		self.assertEqual(wishlists[0].name, "mike's hard wishlist")
 
+	def test_update_with_loaded_revision(self):
+		""" Update a Wishlist with a single write of the revision it was read at """
+		Wishlist("mike's wishlist", "mike").save()
+		wishlist = Wishlist.all()[0]
+		old_rev = wishlist.rev
+		with patch('cloudant.document.Document.fetch') as fetch_mock:
+			self.assertTrue(wishlist.save())
+			self.assertFalse(fetch_mock.called)
+		self.assertNotEqual(wishlist.rev, old_rev)
+		self.assertEqual(Wishlist.revision(wishlist.id), wishlist.rev)
+
+	def test_update_conflict(self):
+		""" Update a Wishlist that was changed since it was read """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		stale = Wishlist.find(wishlist.id)
+		wishlist.name = "mike's hard wishlist"
+		wishlist.save()
+		stale.name = "mike's easy wishlist"
+		self.assertRaises(DataConflictError, stale.save)
+		self.assertEqual(Wishlist.find(wishlist.id).name, "mike's hard wishlist")
+
 	def test_delete_a_wishlist(self):
 		""" Delete a Wishlists """
 		wishlist = Wishlist("mike's wishlist", "mike")
@@ -110,6 +141,143 @@ class TestWishlists(unittest.TestCase):
 		wishlist.delete_wishlist()
 		self.assertEqual(len(Wishlist.all()), 0)
 
+	def test_remove_by_user(self):
+		""" Delete all Wishlists of a user in batches """
+		Wishlist("mike's wishlist", "mike").save()
+		Wishlist("mike's other wishlist", "mike").save()
+		Wishlist("mike's last wishlist", "mike").save()
+		Wishlist("joan's wishlist", "joan").save()
+		deleted = Wishlist.remove_by_user("mike", batch_size=2)
+		self.assertEqual(deleted, 3)
+		wishlists = Wishlist.all()
+		self.assertEqual(len(wishlists), 1)
+		self.assertEqual(wishlists[0].user, "joan")
+
+	def test_remove_all_in_batches(self):
+		""" Delete all Wishlists with small _bulk_docs batches """
+		for i in range(5):
+			Wishlist("wishlist {}".format(i), "mike").save()
+		deleted = Wishlist.remove_all(batch_size=2)
+		self.assertEqual(deleted, 5)
+		self.assertEqual(len(Wishlist.all()), 0)
+		# the index design documents survive
+		indexes = Wishlist.database.get_query_indexes(raw_result=True)['indexes']
+		self.assertIn('_design/wishlist-user', [index['ddoc'] for index in indexes])
+
+	def test_bulk_delete_conflict(self):
+		""" Bulk delete with a stale revision deletes nothing """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		stub = {'_id': wishlist.id, '_rev': '1-00000000000000000000000000000000'}
+		self.assertEqual(Wishlist.bulk_delete([stub]), 0)
+		self.assertEqual(len(Wishlist.all()), 1)
+
+	def test_bulk_create(self):
+		""" Create Wishlists in batches with _bulk_docs """
+		wishlists = [Wishlist("wishlist {}".format(i), "mike") for i in range(5)]
+		errors = Wishlist.bulk_create(wishlists, batch_size=2)
+		self.assertEqual(errors, [None] * 5)
+		for wishlist in wishlists:
+			self.assertIsNotNone(wishlist.id)
+		self.assertEqual(len(Wishlist.find_by_user("mike")), 5)
+
+	@patch('cloudant.database.CouchDatabase.bulk_docs')
+	def test_bulk_create_http_error(self, bad_mock):
+		""" Bulk create reports an error for each wishlist of a failed batch """
+		bad_mock.side_effect = HTTPError('boom')
+		wishlists = [Wishlist("wishlist {}".format(i), "mike") for i in range(3)]
+		errors = Wishlist.bulk_create(wishlists)
+		self.assertEqual(len(errors), 3)
+		self.assertTrue(all(errors))
+		self.assertIsNone(wishlists[0].id)
+
+	def test_delete_by_id(self):
+		""" Delete a Wishlist by id without reading it first """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		with patch('cloudant.document.Document.fetch') as fetch_mock:
+			self.assertTrue(Wishlist.delete_by_id(wishlist.id))
+			self.assertFalse(fetch_mock.called)
+		self.assertEqual(len(Wishlist.all()), 0)
+		self.assertFalse(Wishlist.delete_by_id(wishlist.id))
+
+	def test_delete_by_id_conflict(self):
+		""" Delete a Wishlist at a revision that is no longer current """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		old_rev = wishlist.rev
+		wishlist.name = "mike's hard wishlist"
+		wishlist.save()
+		self.assertRaises(DataConflictError, Wishlist.delete_by_id, wishlist.id, old_rev)
+		self.assertTrue(Wishlist.delete_by_id(wishlist.id, wishlist.rev))
+
+	def test_add_entry(self):
+		""" Add an entry to a stored Wishlist """
+		wishlist = Wishlist("mike's wishlist", "mike", [Wishlist_entry(0, "kite")])
+		wishlist.save()
+		entry = Wishlist.add_entry(wishlist.id, Wishlist_entry(item_name="bike"))
+		self.assertEqual(entry.id, 1)
+		entries = Wishlist.find(wishlist.id).entries
+		self.assertEqual([e.name for e in entries], ["kite", "bike"])
+		self.assertIsNone(Wishlist.add_entry("asdf123", Wishlist_entry(item_name="car")))
+
+	def test_delete_entry(self):
+		""" Delete an entry from a stored Wishlist """
+		wishlist = Wishlist("mike's wishlist", "mike",
+							[Wishlist_entry(0, "kite"), Wishlist_entry(1, "bike")])
+		wishlist.save()
+		self.assertTrue(Wishlist.delete_entry(wishlist.id, 0))
+		entries = Wishlist.find(wishlist.id).entries
+		self.assertEqual(len(entries), 1)
+		self.assertEqual(entries[0].name, "bike")
+		self.assertFalse(Wishlist.delete_entry(wishlist.id, 0))
+		self.assertFalse(Wishlist.delete_entry("asdf123", 1))
+
+	def test_deserialize_entry_with_no_name(self):
+		""" Deserialize an entry without a name """
+		self.assertRaises(DataValidationError, Wishlist_entry().deserialize, {"id": 0})
+		self.assertRaises(DataValidationError, Wishlist_entry().deserialize, None)
+
+	def test_patch(self):
+		""" Rename a Wishlist with a JSON Patch """
+		wishlist = Wishlist("mike's wishlist", "mike", [Wishlist_entry(0, "kite")])
+		wishlist.save()
+		patched = Wishlist.patch(wishlist.id, [
+			{"op": "test", "path": "/name", "value": "mike's wishlist"},
+			{"op": "replace", "path": "/name", "value": "mike's new wishlist"},
+			{"op": "add", "path": "/entries/-", "value": {"id": 1, "name": "bike"}}])
+		self.assertEqual(patched.name, "mike's new wishlist")
+		self.assertNotEqual(patched.rev, wishlist.rev)
+		found = Wishlist.find(wishlist.id)
+		self.assertEqual(found.name, "mike's new wishlist")
+		self.assertEqual([e.name for e in found.entries], ["kite", "bike"])
+		self.assertIsNone(Wishlist.patch("asdf123", []))
+
+	def test_patch_invalid(self):
+		""" Reject JSON Patches that fail or break the Wishlist """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		bad_patches = [
+			{"op": "replace", "path": "/name", "value": ""},
+			[{"op": "remove", "path": "/user"}],
+			[{"op": "add", "path": "/_deleted", "value": True}],
+			[{"op": "test", "path": "/name", "value": "joan's wishlist"}],
+			[{"op": "add", "path": "/entries/-", "value": {"id": 1}}],
+			[{"op": "replace", "path": "/missing/path", "value": 1}]]
+		for operations in bad_patches:
+			self.assertRaises(DataValidationError, Wishlist.patch, wishlist.id, operations)
+		self.assertEqual(Wishlist.find(wishlist.id).name, "mike's wishlist")
+
+	def test_patch_conflict(self):
+		""" Patch a Wishlist at a revision that is no longer current """
+		wishlist = Wishlist("mike's wishlist", "mike")
+		wishlist.save()
+		old_rev = wishlist.rev
+		wishlist.save()
+		operations = [{"op": "replace", "path": "/name", "value": "mike's new wishlist"}]
+		self.assertRaises(DataConflictError, Wishlist.patch, wishlist.id, operations, old_rev)
+		self.assertIsNotNone(Wishlist.patch(wishlist.id, operations, wishlist.rev))
+
 	def test_save_without_attribute(self):
 		wishlist_empty = Wishlist()
 		self.assertRaises(DataValidationError, wishlist_empty.save)
@@ -180,6 +348,13 @@ class TestWishlists(unittest.TestCase):
 	# 	wishlist.delete_entry(0)
 	# 	self.assertEqual(len(wishlist.entries), 0)
 
+	def test_entries_default_not_shared(self):
+		""" Wishlists created without entries do not share a list """
+		first = Wishlist("first", "mike")
+		first.entries.append(Wishlist_entry(0, "car"))
+		self.assertEqual(Wishlist("second", "mike").entries, [])
+		self.assertRaises(AttributeError, setattr, first, "color", "red")
+
 	def test_deserialize_wishlist(self):
 		""" Test deserialization of a Wishlist """
 		data = {"name": "mikes wishlist", "user": "mike", "entries": [
@@ -240,6 +415,38 @@ class TestWishlists(unittest.TestCase):
 		self.assertEqual(wishlist.id, saved_wishlist.id)
 		self.assertEqual(wishlist.name, "joan's wishlist")
 
+	def test_find_uses_cache(self):
+		""" Find a wishlist twice and hit the cache the second time """
+		saved_wishlist = Wishlist("joan's wishlist", "joan")
+		saved_wishlist.save()
+		Wishlist.cache.clear()
+		hits = Wishlist.cache.hits
+		Wishlist.find(saved_wishlist.id)
+		with patch('cloudant.document.Document.fetch') as fetch_mock:
+			wishlist = Wishlist.find(saved_wishlist.id)
+			self.assertFalse(fetch_mock.called)
+		self.assertEqual(wishlist.name, "joan's wishlist")
+		self.assertEqual(Wishlist.cache.hits, hits + 1)
+
+	def test_update_invalidates_cache(self):
+		""" Updating a wishlist drops its cached document """
+		saved_wishlist = Wishlist("joan's wishlist", "joan")
+		saved_wishlist.save()
+		wishlist = Wishlist.find(saved_wishlist.id)
+		wishlist.name = "joan's new wishlist"
+		wishlist.save()
+		self.assertEqual(Wishlist.find(saved_wishlist.id).name, "joan's new wishlist")
+		wishlist.delete_wishlist()
+		self.assertIsNone(Wishlist.find(saved_wishlist.id))
+
+	def test_revision(self):
+		""" Read the revision of a wishlist with a HEAD request """
+		wishlist = Wishlist("joan's wishlist", "joan")
+		wishlist.save()
+		found = Wishlist.find(wishlist.id)
+		self.assertEqual(Wishlist.revision(wishlist.id), found.rev)
+		self.assertIsNone(Wishlist.revision("asdf123"))
+
 	def test_find_with_no_wishlists(self):
 		""" Find a Wishlist with no Wishlists """
 		wishlist = Wishlist.find("1")
@@ -269,6 +476,39 @@ class TestWishlists(unittest.TestCase):
 		self.assertEqual(wishlists[0].user, "mike")
 		self.assertEqual(wishlists[0].name, "mike's wishlist")
 
+	def test_find_by_user_and_name(self):
+		""" Find a user's Wishlist by Name """
+		Wishlist("birthday", "mike").save()
+		Wishlist("birthday", "joan").save()
+		Wishlist("holidays", "mike").save()
+		wishlists = Wishlist.find_by_user_and_name("mike", "birthday")
+		self.assertEqual(len(wishlists), 1)
+		self.assertEqual(wishlists[0].user, "mike")
+		self.assertEqual(wishlists[0].name, "birthday")
+
+	def test_indexes_created(self):
+		""" init_db creates the indexes used by the finders """
+		indexes = Wishlist.database.get_query_indexes(raw_result=True)['indexes']
+		ddocs = [index['ddoc'] for index in indexes]
+		for ddoc, _ in QUERY_INDEXES:
+			self.assertIn('_design/' + ddoc, ddocs)
+
+	def test_stale_index_replaced(self):
+		""" ensure_indexes rebuilds an index with the wrong fields """
+		Wishlist.database.delete_query_index('wishlist-user', 'json', 'wishlist-user')
+		Wishlist.database.create_query_index(design_document_id='wishlist-user',
+											 index_name='wishlist-user',
+											 fields=['name'])
+		Wishlist.engine.ensure_indexes()
+		indexes = Wishlist.database.get_query_indexes(raw_result=True)['indexes']
+		user_index = [i for i in indexes if i['ddoc'] == '_design/wishlist-user'][0]
+		self.assertEqual(user_index['def']['fields'], [{'user': 'asc'}])
+
+	def test_all_skips_design_documents(self):
+		""" All() ignores the design documents holding the indexes """
+		Wishlist("mike's wishlist", "mike").save()
+		self.assertEqual(len(Wishlist.all()), 1)
+
 	def test_all(self):
 		""" All() should return a list of all wishlists """
 		Wishlist("mike's wishlist", "mike").save()
@@ -276,6 +516,34 @@ class TestWishlists(unittest.TestCase):
 		wishlists = Wishlist.all()
 		self.assertEqual(len(wishlists), 2)
 
+	def test_page(self):
+		""" Page through all wishlists with a cursor """
+		Wishlist("mike's wishlist", "mike").save()
+		Wishlist("joan's wishlist", "joan").save()
+		Wishlist("mike's other wishlist", "mike").save()
+		wishlists, cursor = Wishlist.page(2)
+		self.assertEqual(len(wishlists), 2)
+		self.assertIsNotNone(cursor)
+		rest, cursor = Wishlist.page(2, cursor)
+		self.assertEqual(len(rest), 1)
+		self.assertIsNone(cursor)
+		ids = set(w.id for w in wishlists + rest)
+		self.assertEqual(len(ids), 3)
+
+	def test_page_by_user(self):
+		""" Page through the wishlists of a user """
+		Wishlist("mike's wishlist", "mike").save()
+		Wishlist("joan's wishlist", "joan").save()
+		Wishlist("mike's other wishlist", "mike").save()
+		wishlists, cursor = Wishlist.page(1, user="mike")
+		self.assertEqual(len(wishlists), 1)
+		self.assertEqual(wishlists[0].user, "mike")
+		self.assertIsNotNone(cursor)
+		rest, cursor = Wishlist.page(5, cursor, user="mike")
+		self.assertEqual(len(rest), 1)
+		self.assertEqual(rest[0].user, "mike")
+		self.assertNotEqual(rest[0].id, wishlists[0].id)
+
 	# @patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(VCAP_SERVICES)})
 	# def test_vcap_services(self):
 	#     """ Test if VCAP_SERVICES works """
@@ -336,6 +604,614 @@ class TestWishlists(unittest.TestCase):
 		bad_mock.side_effect = ConnectionError()
 		self.assertRaises(AssertionError, Wishlist.init_db, 'test')
 
+class TestLRUCache(unittest.TestCase):
+	""" Tests of the bounded read-through cache """
+
+	def setUp(self):
+		self.now = [0]
+		self.cache = LRUCache(maxsize=2, ttl=10, timer=lambda: self.now[0])
+
+	def test_hit_and_miss(self):
+		""" A cached value is returned until invalidated """
+		self.assertIsNone(self.cache.get('a'))
+		self.cache.put('a', 1)
+		self.assertEqual(self.cache.get('a'), 1)
+		self.cache.invalidate('a')
+		self.assertIsNone(self.cache.get('a'))
+		stats = self.cache.stats()
+		self.assertEqual(stats['hits'], 1)
+		self.assertEqual(stats['misses'], 2)
+
+	def test_evicts_least_recently_used(self):
+		""" The least recently used entry is evicted when full """
+		self.cache.put('a', 1)
+		self.cache.put('b', 2)
+		self.cache.get('a')
+		self.cache.put('c', 3)
+		self.assertIsNone(self.cache.get('b'))
+		self.assertEqual(self.cache.get('a'), 1)
+		self.assertEqual(self.cache.get('c'), 3)
+		self.assertEqual(self.cache.stats()['evictions'], 1)
+
+	def test_expires_after_ttl(self):
+		""" Entries older than the TTL are not returned """
+		self.cache.put('a', 1)
+		self.now[0] = 11
+		self.assertIsNone(self.cache.get('a'))
+		self.assertEqual(self.cache.stats()['expirations'], 1)
+		self.assertEqual(self.cache.stats()['size'], 0)
+
+	def test_disabled(self):
+		""" A cache of size 0 stores nothing """
+		cache = LRUCache(maxsize=0)
+		cache.put('a', 1)
+		self.assertIsNone(cache.get('a'))
+
+class TestMemoryEngine(unittest.TestCase):
+	""" Tests of the Wishlist model on the in-memory storage engine """
+	engine = "memory"
+
+	def setUp(self):
+		Wishlist.init_db("test", engine=self.engine)
+		Wishlist.remove_all()
+
+	def tearDown(self):
+		Wishlist.init_db("test", engine=self.engine)
+		Wishlist.remove_all()
+
+	def test_create_and_find(self):
+		""" A created Wishlist can be found by id, user and name """
+		wishlist = Wishlist("mike's wishlist", "mike", [Wishlist_entry(0, "car")])
+		self.assertTrue(wishlist.save())
+		self.assertIsNotNone(wishlist.rev)
+		found = Wishlist.find(wishlist.id)
+		self.assertEqual(found.name, "mike's wishlist")
+		self.assertEqual(found.entries[0].name, "car")
+		self.assertEqual(len(Wishlist.find_by_user("mike")), 1)
+		self.assertEqual(len(Wishlist.find_by_name("mike's wishlist")), 1)
+		self.assertEqual(Wishlist.find_by_user_and_name("mike", "other"), [])
+
+	def test_update_and_conflict(self):
+		""" Updates move the secondary indexes and check the revision """
+		wishlist = Wishlist("mike's wishlist", "mike", [])
+		wishlist.save()
+		stale = Wishlist.find(wishlist.id, cached=False)
+		wishlist.user = "joan"
+		self.assertTrue(wishlist.save())
+		self.assertEqual(Wishlist.find_by_user("mike"), [])
+		self.assertEqual(len(Wishlist.find_by_user("joan")), 1)
+		stale.name = "stale"
+		self.assertRaises(DataConflictError, stale.save)
+
+	def test_delete(self):
+		""" A deleted Wishlist is gone from the id and secondary indexes """
+		wishlist = Wishlist("mike's wishlist", "mike", [])
+		wishlist.save()
+		self.assertTrue(wishlist.delete_wishlist())
+		self.assertIsNone(Wishlist.find(wishlist.id))
+		self.assertEqual(Wishlist.find_by_user("mike"), [])
+		self.assertFalse(Wishlist.delete_by_id(wishlist.id))
+
+	def test_page_and_remove_by_user(self):
+		""" Pages follow the id order and removal is per user """
+		Wishlist.bulk_create([Wishlist(str(i), "mike", []) for i in range(5)])
+		Wishlist("other", "joan", []).save()
+		first, cursor = Wishlist.page(3, user="mike")
+		second, last = Wishlist.page(3, cursor, user="mike")
+		self.assertEqual(len(first), 3)
+		self.assertEqual(len(second), 2)
+		self.assertIsNone(last)
+		self.assertEqual(len(set(w.id for w in first + second)), 5)
+		self.assertEqual(Wishlist.remove_by_user("mike", batch_size=2), 5)
+		self.assertEqual(len(Wishlist.all()), 1)
+
+	def test_entries(self):
+		""" Entries are added with the next free id and deleted by id """
+		wishlist = Wishlist("mike's wishlist", "mike", [Wishlist_entry(0, "car")])
+		wishlist.save()
+		entry = Wishlist.add_entry(wishlist.id, Wishlist_entry(item_name="bike"))
+		self.assertEqual(entry.id, 1)
+		self.assertTrue(Wishlist.delete_entry(wishlist.id, 0))
+		self.assertFalse(Wishlist.delete_entry(wishlist.id, 0))
+		self.assertEqual([e.name for e in Wishlist.find(wishlist.id).entries], ["bike"])
+		self.assertIsNone(Wishlist.add_entry("asdf123", Wishlist_entry(item_name="bike")))
+
+	def test_projected(self):
+		""" Projected documents match serialized Wishlists """
+		wishlist = Wishlist("mike's wishlist", "mike", [Wishlist_entry(0, "car")])
+		wishlist.save()
+		Wishlist("other", "joan", []).save()
+		projected, cursor = Wishlist.page_projected(10, user="mike")
+		self.assertIsNone(cursor)
+		self.assertEqual(projected, [wishlist.serialize()])
+		self.assertEqual(len(list(Wishlist.iterate_projected(batch_size=1))), 2)
+
+	def test_unknown_engine(self):
+		""" Only registered storage engines can be opened """
+		self.assertRaises(AssertionError, Wishlist.init_db, "test", "nosuchengine")
+
+	def test_cache_dropped_after_write(self):
+		""" A find racing an update does not cache the old document again """
+		wishlist = Wishlist("old", "mike", [])
+		wishlist.save()
+		update = Wishlist.engine.update
+		def racing_update(*args):
+			Wishlist.find(wishlist.id)
+			return update(*args)
+		wishlist.name = "new"
+		with patch.object(Wishlist.engine, 'update', side_effect=racing_update):
+			wishlist.save()
+		self.assertEqual(Wishlist.find(wishlist.id).name, "new")
+
+	def test_cache_checks_revision(self):
+		""" A document changed or deleted by another worker is not served from the cache """
+		wishlist = Wishlist("old", "mike", [])
+		wishlist.save()
+		Wishlist.find(wishlist.id)
+		document = Wishlist.engine.get(wishlist.id)
+		document['name'] = "new"
+		Wishlist.engine.update(wishlist.id, wishlist.rev, document)
+		self.assertEqual(Wishlist.find(wishlist.id).name, "new")
+		Wishlist.engine.delete(wishlist.id, Wishlist.revision(wishlist.id))
+		self.assertIsNone(Wishlist.find(wishlist.id))
+
+	def test_bulk_create_unavailable(self):
+		""" A batch that cannot reach the database keeps the ids of earlier batches """
+		bulk_create = Wishlist.engine.bulk_create
+		calls = []
+		def fail_second_batch(documents):
+			calls.append(documents)
+			if len(calls) == 2:
+				raise CircuitOpenError('The database is unavailable', 1)
+			return bulk_create(documents)
+		wishlists = [Wishlist("wishlist {}".format(i), "mike") for i in range(5)]
+		with patch.object(Wishlist.engine, 'bulk_create', side_effect=fail_second_batch):
+			errors = Wishlist.bulk_create(wishlists, batch_size=2)
+		self.assertEqual(errors[:2], [None, None])
+		self.assertEqual([error[0] for error in errors[2:4]], ['unavailable'] * 2)
+		self.assertIsNone(errors[4])
+		self.assertIsNotNone(wishlists[0].id)
+		self.assertIsNone(wishlists[2].id)
+		self.assertEqual(len(Wishlist.find_by_user("mike")), 3)
+
+class TestSQLiteEngine(TestMemoryEngine):
+	""" Runs the storage engine tests on the SQLite storage engine """
+	engine = "sqlite"
+
+	@classmethod
+	def setUpClass(cls):
+		cls.sqlite_dir = patch('app.models.SQLITE_DIR', tempfile.mkdtemp())
+		cls.sqlite_dir.start()
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(models.SQLITE_DIR)
+		cls.sqlite_dir.stop()
+
+	def test_uses_indexes(self):
+		""" Lookups by user and name seek the B-tree indexes """
+		table = Wishlist.engine.wishlists
+		for field in ('user', 'name'):
+			plan = Wishlist.engine.db.execute(
+				'EXPLAIN QUERY PLAN ' + str(table.select().where(table.c[field] == 'mike')
+											.compile(compile_kwargs={'literal_binds': True}))
+			).fetchall()
+			self.assertIn('USING INDEX', ' '.join(str(row[-1]) for row in plan))
+
+	def test_wal_mode(self):
+		""" The database runs in write-ahead logging mode """
+		self.assertEqual(Wishlist.engine.db.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+	def test_bulk_create_existing_id(self):
+		""" A taken id fails only its own document of a batch """
+		wishlist = Wishlist("mike's wishlist", "mike", [])
+		wishlist.save()
+		results = Wishlist.engine.bulk_create([
+			{'name': 'new', 'user': 'mike', 'entries': []},
+			{'_id': wishlist.id, 'name': 'taken', 'user': 'mike', 'entries': []}])
+		self.assertTrue(results[0]['ok'])
+		self.assertEqual(results[1]['error'], 'conflict')
+		self.assertEqual(len(Wishlist.find_by_user("mike")), 2)
+
+class TestRetryPolicy(unittest.TestCase):
+	""" Tests of the retry policy of storage I/O """
+
+	def setUp(self):
+		self.now = [0]
+		self.sleeps = []
+		self.policy = RetryPolicy(tries=4, delay=1, max_delay=3, budget=2, deadline=10,
+								  timer=lambda: self.now[0], sleep=self.sleeps.append,
+								  jitter=lambda: 1)
+
+	@staticmethod
+	def http_error(status_code, headers=None):
+		""" Builds an HTTPError carrying a response """
+		response = Response()
+		response.status_code = status_code
+		response.headers.update(headers or {})
+		return HTTPError(response=response)
+
+	def failing(self, *errors):
+		""" Returns a function raising errors in turn, then returning 'ok' """
+		errors = list(errors)
+		def function():
+			if errors:
+				raise errors.pop(0)
+			return 'ok'
+		return function
+
+	def test_retries_with_backoff(self):
+		""" Transient errors are retried with exponential, capped delays """
+		function = self.failing(self.http_error(503), ConnectionError(), self.http_error(500))
+		self.assertEqual(self.policy.call(function), 'ok')
+		self.assertEqual(self.sleeps, [1, 2, 3])
+		self.assertEqual(self.policy.stats(), {'retries': 3, 'exhausted': 0})
+
+	def test_permanent_error_not_retried(self):
+		""" Client errors are raised at once """
+		function = self.failing(self.http_error(404))
+		self.assertRaises(HTTPError, self.policy.call, function)
+		self.assertEqual(self.sleeps, [])
+
+	def test_retry_after(self):
+		""" Retry-After raises the delay """
+		self.policy.call(self.failing(self.http_error(429, {'Retry-After': '5'})))
+		self.assertEqual(self.sleeps, [5])
+
+	def test_request_budget(self):
+		""" A request only gets its budget of retries """
+		self.policy.start_request()
+		self.policy.call(self.failing(ConnectionError()))
+		function = self.failing(ConnectionError(), ConnectionError())
+		self.assertRaises(DatabaseConnectionError, self.policy.call, function)
+		self.assertEqual(len(self.sleeps), 2)
+		self.assertEqual(self.policy.stats()['exhausted'], 1)
+		self.policy.end_request()
+		self.assertEqual(self.policy.call(self.failing(ConnectionError(), ConnectionError())), 'ok')
+
+	def test_request_deadline(self):
+		""" No retry sleeps past the deadline of the request """
+		self.policy.start_request(deadline=2)
+		self.now[0] = 1.5
+		self.assertRaises(HTTPError, self.policy.call, self.failing(self.http_error(503)))
+		self.assertEqual(self.sleeps, [])
+
+class TestCircuitBreaker(unittest.TestCase):
+	""" Tests of the circuit breaker of storage I/O """
+
+	def setUp(self):
+		self.now = [0]
+		self.breaker = CircuitBreaker(window=4, min_calls=4, failure_ratio=0.5,
+									  slow_call=2, reset_timeout=10, timer=lambda: self.now[0])
+
+	def fail(self):
+		""" A call failing with a connection error """
+		raise ConnectionError()
+
+	def slow(self):
+		""" A call taking longer than slow_call """
+		self.now[0] += 3
+
+	def trip(self):
+		""" Opens the breaker with failing calls """
+		for _ in range(2):
+			self.breaker.call(lambda: None)
+			self.assertRaises(ConnectionError, self.breaker.call, self.fail)
+
+	def test_opens_on_errors(self):
+		""" Half of the window failing opens the breaker, which then fails fast """
+		self.trip()
+		self.assertEqual(self.breaker.stats()['state'], 'open')
+		called = []
+		with self.assertRaises(CircuitOpenError) as context:
+			self.breaker.call(lambda: called.append(1))
+		self.assertEqual(called, [])
+		self.assertEqual(context.exception.retry_after, 10)
+		self.assertTrue(isinstance(context.exception, DatabaseConnectionError))
+
+	def test_opens_on_latency(self):
+		""" Slow calls count as failures """
+		for _ in range(2):
+			self.breaker.call(lambda: None)
+			self.breaker.call(self.slow)
+		self.assertEqual(self.breaker.stats()['state'], 'open')
+
+	def test_client_errors_are_healthy(self):
+		""" Errors that are not transient do not open the breaker """
+		response = Response()
+		response.status_code = 404
+		def not_found():
+			raise HTTPError(response=response)
+		for _ in range(4):
+			self.assertRaises(HTTPError, self.breaker.call, not_found)
+		self.assertEqual(self.breaker.stats()['state'], 'closed')
+
+	def test_half_open_probe(self):
+		""" After the reset timeout one probe decides whether to close """
+		self.trip()
+		self.now[0] += 10
+		self.assertRaises(ConnectionError, self.breaker.call, self.fail)
+		self.assertEqual(self.breaker.stats()['state'], 'open')
+		self.assertRaises(CircuitOpenError, self.breaker.call, lambda: None)
+		self.now[0] += 10
+		self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+		self.assertEqual(self.breaker.stats(), {'state': 'closed', 'opened': 2, 'rejected': 1})
+
+	def test_retry_stops_at_open_breaker(self):
+		""" The retry policy does not retry a refused call """
+		sleeps = []
+		policy = RetryPolicy(sleep=sleeps.append, jitter=lambda: 1)
+		self.trip()
+		self.assertRaises(CircuitOpenError, policy.call, self.breaker(lambda: None))
+		self.assertEqual(sleeps, [])
+
+class TestConcurrencyLimiter(unittest.TestCase):
+	""" Tests of the adaptive limit of storage requests in flight """
+
+	def setUp(self):
+		self.now = [0]
+		self.limiter = ConcurrencyLimiter(initial=2, minimum=1, maximum=3, decrease=0.5,
+										  max_queue=1, queue_timeout=0, timer=lambda: self.now[0])
+
+	@staticmethod
+	def throttle(retry_after=None):
+		""" A request answered with 429 Too Many Requests """
+		response = Response()
+		response.status_code = 429
+		if retry_after:
+			response.headers['Retry-After'] = retry_after
+		raise HTTPError(response=response)
+
+	def test_additive_increase(self):
+		""" Successes raise the limit up to its maximum """
+		for _ in range(10):
+			self.limiter.call(lambda: None)
+		self.assertEqual(self.limiter.stats()['limit'], 3)
+
+	def test_multiplicative_decrease_once_per_round(self):
+		""" 429s from requests sent under one limit halve it once """
+		first, second = self.limiter.acquire(), self.limiter.acquire()
+		self.limiter.release(first, throttled=True)
+		self.limiter.release(second, throttled=True)
+		self.assertEqual(self.limiter.limit, 1)
+		self.assertEqual(self.limiter.stats()['throttled'], 2)
+		self.assertEqual(self.limiter.stats()['in_flight'], 0)
+
+	def test_retry_after_pauses(self):
+		""" No request starts before the Retry-After has passed """
+		self.assertRaises(HTTPError, self.limiter.call, lambda: self.throttle('5'))
+		with self.assertRaises(StorageOverloadError) as context:
+			self.limiter.call(lambda: None)
+		self.assertEqual(context.exception.retry_after, 5)
+		self.now[0] = 5
+		self.assertEqual(self.limiter.call(lambda: 'ok'), 'ok')
+
+	def test_sheds_when_queue_full(self):
+		""" Requests over the limit are shed once the queue is full """
+		self.limiter.acquire()
+		self.limiter.acquire()
+		self.limiter.waiting = 1
+		self.assertRaises(StorageOverloadError, self.limiter.acquire)
+		self.assertEqual(self.limiter.stats()['shed'], 1)
+
+	def test_nested_requests_pass_through(self):
+		""" A thread holding a slot is not queued behind itself """
+		limiter = ConcurrencyLimiter(initial=1, queue_timeout=0)
+		self.assertEqual(limiter.call(lambda: limiter.call(lambda: 'ok')), 'ok')
+
+	def test_queued_request_runs_when_slot_frees(self):
+		""" A waiting request starts as soon as a slot is released """
+		limiter = ConcurrencyLimiter(initial=1, maximum=1, queue_timeout=5)
+		started, release = threading.Event(), threading.Event()
+		holder = threading.Thread(target=limiter.call,
+								  args=(lambda: started.set() or release.wait(),))
+		holder.start()
+		started.wait()
+		threading.Timer(0.05, release.set).start()
+		self.assertEqual(limiter.call(lambda: 'ok'), 'ok')
+		holder.join()
+
+class TestMetrics(unittest.TestCase):
+	""" Tests of the per-thread metrics reported by /metrics """
+
+	def setUp(self):
+		self.now = [0]
+		self.metrics = Metrics(buckets=(0.1, 1.0), timer=lambda: self.now[0])
+		self.metrics.family('calls_total', 'counter', 'Calls', ('name',))
+		self.metrics.family('latency_seconds', 'histogram', 'Latency', ('name',))
+
+	def test_threads_added_up(self):
+		""" Values recorded by finished threads are kept and added up """
+		def record():
+			for _ in range(100):
+				self.metrics.inc('calls_total', ('a',))
+		threads = [threading.Thread(target=record) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.metrics.inc('calls_total', ('a',))
+		self.assertEqual(self.metrics.snapshot()[('calls_total', ('a',))], 401)
+		self.assertEqual(len(self.metrics.threads), 1)
+
+	def test_render_histogram(self):
+		""" Histograms are rendered with cumulative buckets, sum and count """
+		for seconds in (0.05, 0.5, 5):
+			self.metrics.observe('latency_seconds', ('a"b',), seconds)
+		text = self.metrics.render()
+		self.assertIn('# TYPE latency_seconds histogram', text)
+		self.assertIn('latency_seconds_bucket{name="a\\"b",le="0.1"} 1', text)
+		self.assertIn('latency_seconds_bucket{name="a\\"b",le="1.0"} 2', text)
+		self.assertIn('latency_seconds_bucket{name="a\\"b",le="+Inf"} 3', text)
+		self.assertIn('latency_seconds_sum{name="a\\"b"} 5.55', text)
+		self.assertIn('latency_seconds_count{name="a\\"b"} 3', text)
+
+	def test_measured_engine(self):
+		""" Calls of the Wishlist model are timed by operation and outcome """
+		engine = MeasuredEngine(models.MemoryEngine(), 'memory', self.metrics)
+		engine.create({'name': 'fido', 'user': 'dog', 'entries': []})
+		self.assertEqual(len(list(engine.iterate({}, 10))), 1)
+		self.assertRaises(TypeError, engine.get)
+		values = self.metrics.snapshot()
+		duration = 'wishlist_storage_request_duration_seconds'
+		for labels in (('memory', 'create', 'ok'), ('memory', 'iterate', 'ok'),
+					   ('memory', 'get', 'error')):
+			self.assertEqual(values[(duration, labels)], [1, 0, 0, 0.0])
+		self.assertEqual(values[('wishlist_storage_requests_in_flight', ('memory',))], 0)
+
+	def test_round_trips(self):
+		""" Storage calls are counted per operation while a request is served """
+		round_trips = RoundTrips()
+		engine = MeasuredEngine(models.MemoryEngine(), 'memory', self.metrics, round_trips)
+		engine.get('1')
+		round_trips.start_request()
+		engine.get('1')
+		engine.get('2')
+		engine.revision('1')
+		self.assertEqual(round_trips.calls(), {'get': [2, 0], 'revision': [1, 0]})
+		round_trips.end_request()
+		self.assertEqual(round_trips.calls(), {})
+
+class TestCloudantEngine(unittest.TestCase):
+	""" Tests of the Cloudant engine against a mocked database """
+
+	def setUp(self):
+		self.engine = models.CloudantEngine(mock.MagicMock(), mock.MagicMock())
+
+	def test_invalid_bookmark(self):
+		""" A cursor CouchDB rejects is a validation error """
+		response = Response()
+		response.status_code = 400
+		with patch('app.models.Query') as query:
+			query.return_value.side_effect = HTTPError(response=response)
+			self.assertRaises(DataValidationError, self.engine.query, {'user': 'fido'}, 5, 'bad')
+
+	def test_entry_handler_conflict(self):
+		""" Entry update handlers are run again while they conflict """
+		conflict, created = Response(), Response()
+		conflict.status_code = 409
+		created.status_code = 201
+		created._content = '{"id": 2, "name": "bike"}'
+		self.engine.database.r_session.put.side_effect = [conflict, created]
+		with patch('app.models.update_handler_url', return_value='url'):
+			self.assertEqual(self.engine.add_entry('1', 'bike'), {'id': 2, 'name': 'bike'})
+			self.engine.database.r_session.put.side_effect = None
+			self.engine.database.r_session.put.return_value = conflict
+			self.assertRaises(DataConflictError, self.engine.delete_entry, '1', 2)
+
+	def test_remove_all_guarded(self):
+		""" Pages of _all_docs read by remove go through the storage guards """
+		self.engine.database.all_docs.return_value = {'rows': []}
+		with patch.object(models.storage_limiter, 'acquire', wraps=models.storage_limiter.acquire) \
+				as acquire:
+			self.assertEqual(self.engine.remove({}), 0)
+		self.assertEqual(acquire.call_count, 1)
+
+	def test_queued_request_is_healthy(self):
+		""" Time spent waiting for a limiter slot does not count as a slow request """
+		found = Response()
+		found.status_code = 200
+		found.headers['ETag'] = '"1-abc"'
+		self.engine.database.r_session.head.return_value = found
+		holding = threading.Event()
+		def hold():
+			holding.set()
+			time.sleep(0.5)
+		holder = threading.Thread(target=models.storage_limiter.call, args=(hold,))
+		with patch.object(models.storage_limiter, 'limit', 1.0), \
+				patch.object(models.storage_breaker, 'min_calls', 1), \
+				patch.object(models.storage_breaker, 'slow_call', 0.2), \
+				patch('app.models.Document'):
+			holder.start()
+			holding.wait()
+			try:
+				self.assertEqual(self.engine.revision('1'), '1-abc')
+			finally:
+				holder.join()
+				state = models.storage_breaker.stats()['state']
+				models.storage_breaker.reset()
+		self.assertEqual(state, 'closed')
+
+class TestPooledCloudant(unittest.TestCase):
+	""" Tests of the per-thread sessions of the Cloudant client """
+
+	def setUp(self):
+		self.adapter = KeepAliveAdapter(keepalive=30, pool_maxsize=4, pool_block=True)
+		self.client = PooledCloudant('admin', 'pass', url='http://localhost:5984',
+									 admin_party=True, connect=True, adapter=self.adapter)
+
+	def test_session_per_thread(self):
+		""" Each thread gets its own session on the shared connection pool """
+		sessions = []
+		thread = threading.Thread(target=lambda: sessions.append(self.client.r_session))
+		thread.start()
+		thread.join()
+		self.assertIsNotNone(sessions[0])
+		self.assertIsNot(sessions[0], self.client.r_session)
+		for session in (sessions[0], self.client.r_session):
+			self.assertIs(session.adapters['http://localhost:5984'], self.adapter)
+
+	def test_disconnect_drops_sessions(self):
+		""" After a disconnect no thread has a session """
+		self.client.disconnect()
+		sessions = []
+		thread = threading.Thread(target=lambda: sessions.append(self.client.r_session))
+		thread.start()
+		thread.join()
+		self.assertEqual(sessions, [None])
+		self.assertIsNone(self.client.r_session)
+
+	def test_threads_reuse_login_cookie(self):
+		""" Only connect posts to _session, other threads reuse its cookie """
+		def login(session):
+			session.cookies.set('AuthSession', 'cookie')
+		with patch.object(CookieSession, 'login', autospec=True, side_effect=login) as login_mock:
+			client = PooledCloudant('admin', 'pass', url='http://localhost:5984',
+									connect=True, adapter=self.adapter)
+			sessions = []
+			thread = threading.Thread(target=lambda: sessions.append(client.r_session))
+			thread.start()
+			thread.join()
+		self.assertEqual(login_mock.call_count, 1)
+		self.assertIsNot(sessions[0], client.r_session)
+		self.assertEqual(sessions[0].cookies.get('AuthSession'), 'cookie')
+
+	def test_sessions_record_round_trips(self):
+		""" Every response a session receives counts as a round trip of the request """
+		def respond(session, method):
+			response = Response()
+			response.request = Request(method, 'http://localhost:5984/test').prepare()
+			response.elapsed = timedelta(milliseconds=5)
+			dispatch_hook('response', session.hooks, response)
+		models.storage_round_trips.start_request()
+		try:
+			respond(self.client.r_session, 'HEAD')
+			thread = threading.Thread(target=lambda: respond(self.client.r_session, 'GET'))
+			thread.start()
+			thread.join()
+			respond(self.client.r_session, 'HEAD')
+			self.assertEqual(models.storage_round_trips.http_calls(), {'head': [2, 0.01]})
+		finally:
+			models.storage_round_trips.end_request()
+
+	def test_keepalive_socket_options(self):
+		""" Pooled connections send TCP keep-alive probes """
+		options = self.adapter.poolmanager.connection_pool_kw['socket_options']
+		self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), options)
+		self.assertEqual(self.adapter.poolmanager.connection_pool_kw['maxsize'], 4)
+
+	def test_session_shared_by_greenlets(self):
+		""" Under gevent every greenlet uses the one session """
+		with patch('app.models.is_cooperative', return_value=True):
+			client = PooledCloudant('admin', 'pass', url='http://localhost:5984',
+									admin_party=True, connect=True, adapter=self.adapter)
+		sessions = []
+		thread = threading.Thread(target=lambda: sessions.append(client.r_session))
+		thread.start()
+		thread.join()
+		self.assertIs(sessions[0], client.r_session)
+		self.assertFalse(is_cooperative())
+
 ######################################################################
 #   M A I N
 ######################################################################